@@ -0,0 +1,213 @@
+"""
+Офлайн-бенчмарк сборщика: mainn.py целиком на срезе almaty_roads.csv против локальной
+замены API (fake_yandex.py) с настраиваемой задержкой и долей ошибок.
+
+Каждый прогон идет в отдельном процессе во временной папке и дает точки/с, виды/с, CPU
+(включая процессы обработки изображений) и пиковый RSS. Отдельно замеряются
+crop_panorama_to_roi, autocrop_image, pHash и кодирование JPEG на синтетической панораме.
+
+    python benchmarks/bench_pipeline.py                                   # 40 сегментов, 1 год
+    python benchmarks/bench_pipeline.py --segments 100 --years 2019,2021,2023 --workers 16 --warm
+    python benchmarks/bench_pipeline.py --error-rate 0.05 --latency-ms 200 --json result.json
+    python benchmarks/bench_pipeline.py --raw-store roi --raw-zoom 1       # хранилище исходников
+"""
+import os
+import sys
+import csv
+import json
+import time
+import shutil
+import atexit
+import argparse
+import resource
+import tempfile
+import subprocess
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, BENCH_DIR)
+
+CHILD_REPORT = "bench_child.json"
+METRICS_FILE = "metrics.jsonl"
+
+
+def parse_size(spec: str):
+    width, height = (int(x) for x in spec.lower().split("x"))
+    return width, height
+
+
+def fake_from_args(args):
+    from fake_yandex import FakeYandex
+    return FakeYandex(seed=args.seed, latency_ms=args.latency_ms, download_latency_ms=args.download_latency_ms,
+                      error_rate=args.error_rate, coverage=args.coverage, pano_size=parse_size(args.pano_size))
+
+
+def write_slice(src: str, dst: str, segments: int, offset: int) -> int:
+    """Первые segments строк CSV начиная с offset (заголовок сохраняется)."""
+    written = 0
+    with open(src, newline="", encoding="utf-8") as f_in, open(dst, "w", newline="", encoding="utf-8") as f_out:
+        reader, writer = csv.reader(f_in), csv.writer(f_out)
+        writer.writerow(next(reader))
+        for i, row in enumerate(reader):
+            if i < offset: continue
+            if written >= segments: break
+            writer.writerow(row)
+            written += 1
+    return written
+
+
+def child_main(args, mainn_args):
+    """Процесс прогона: подмена API и запуск mainn.main() в текущей папке."""
+    fake = fake_from_args(args)
+    fake.install()
+
+    def report():
+        # Пул обработки изображений к этому моменту уже остановлен, его процессы учтены в RUSAGE_CHILDREN
+        own, children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+        with open(CHILD_REPORT, "w", encoding="utf-8") as f:
+            json.dump({"calls": fake.calls,
+                       "cpu_seconds": own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime,
+                       "peak_rss_mb": own.ru_maxrss / 1024, "peak_rss_workers_mb": children.ru_maxrss / 1024}, f)
+    atexit.register(report)
+
+    import mainn
+    sys.argv = ["mainn.py"] + mainn_args
+    mainn.main()
+
+
+def run_collector(workdir: str, args, label: str) -> dict:
+    mainn_args = ["--years", args.years, "--workers", str(args.workers), "--image-workers", str(args.image_workers),
+                  "--rps", str(args.rps), "--metrics-file", METRICS_FILE, "--report-seconds", "3600",
+                  "--raw-store", args.raw_store, "--raw-zoom", str(args.raw_zoom), "--raw-store-gb", str(args.raw_store_gb)]
+    child_args = [sys.executable, os.path.abspath(__file__), "--child", "--seed", str(args.seed),
+                  "--latency-ms", str(args.latency_ms), "--download-latency-ms", str(args.download_latency_ms),
+                  "--error-rate", str(args.error_rate), "--coverage", str(args.coverage), "--pano-size", args.pano_size,
+                  "--"] + mainn_args
+    for stale in (CHILD_REPORT, METRICS_FILE):
+        if os.path.exists(os.path.join(workdir, stale)): os.remove(os.path.join(workdir, stale))
+    log_path = os.path.join(workdir, f"collector_{label}.log")
+    start = time.perf_counter()
+    with open(log_path, "w", encoding="utf-8") as log:
+        result = subprocess.run(child_args, cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+    wall = time.perf_counter() - start
+    if result.returncode != 0:
+        sys.exit(f"❌ Прогон {label} завершился с кодом {result.returncode}, см. {log_path}")
+    with open(os.path.join(workdir, CHILD_REPORT), encoding="utf-8") as f: child = json.load(f)
+    with open(os.path.join(workdir, METRICS_FILE), encoding="utf-8") as f: metrics = json.loads(f.read().splitlines()[-1])
+
+    def counter(name):
+        return sum(c["value"] for c in metrics["counters"] if c["name"] == name)
+    loop_seconds = metrics["uptime_seconds"]
+    return {"label": label, "wall_seconds": round(wall, 3), "loop_seconds": loop_seconds,
+            "points": counter("points"), "views": counter("views_saved"), "downloads": counter("downloads"),
+            "errors": counter("errors"), "download_mb": round(counter("download_bytes") / 1e6, 1),
+            "raw_store_mb": round(metrics["gauges"].get("raw_store_bytes", 0) / 1e6, 1), "points_per_second": round(counter("points") / loop_seconds, 3) if loop_seconds else 0,
+            "views_per_second": round(counter("views_saved") / loop_seconds, 3) if loop_seconds else 0,
+            "cpu_seconds": round(child["cpu_seconds"], 3), "peak_rss_mb": round(child["peak_rss_mb"], 1),
+            "peak_rss_workers_mb": round(child["peak_rss_workers_mb"], 1), "api_calls": child["calls"],
+            "stages": metrics["stages"], "log": log_path}
+
+
+def median_ms(fn, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return round(float(np.median(timings)) * 1000, 2)
+
+
+def micro_benchmarks(args) -> dict:
+    """Горячие функции по отдельности на одной синтетической панораме."""
+    import cv2
+    import imagehash
+    from PIL import Image
+    from fake_yandex import synthetic_panorama
+    from projection import crop_panorama_to_roi
+    from mainn import autocrop_image
+    year = args.years.split(",")[0].split("-")[0]
+    img = synthetic_panorama("micro", *parse_size(args.pano_size))
+    crop_panorama_to_roi(img, year)  # построение таблиц remap не входит в замер
+    views = [v["image"] for v in crop_panorama_to_roi(img, year)]
+    pil_views = [Image.fromarray(cv2.cvtColor(v, cv2.COLOR_BGR2RGB)) for v in views]
+    return {
+        "crop_panorama_to_roi_ms": median_ms(lambda: crop_panorama_to_roi(img, year), args.micro_repeat),
+        "autocrop_image_ms": median_ms(lambda: autocrop_image(img), args.micro_repeat),
+        "phash_per_view_ms": median_ms(lambda: [imagehash.phash(v) for v in pil_views], args.micro_repeat) / len(views),
+        "jpeg_encode_per_view_ms": median_ms(lambda: [cv2.imencode(".jpg", v) for v in views], args.micro_repeat) / len(views),
+        "decode_ms": median_ms(lambda: cv2.imdecode(cv2.imencode(".jpg", img)[1], cv2.IMREAD_COLOR), args.micro_repeat),
+    }
+
+
+def print_run(run: dict) -> None:
+    calls = run["api_calls"]
+    print(f"\n▶️  Прогон: {run['label']}")
+    print(f"   Точек: {run['points']:.0f}, видов: {run['views']:.0f}, загрузок: {run['downloads']:.0f}, ошибок: {run['errors']:.0f}")
+    print(f"   Скачано: {run['download_mb']:.1f} МБ, хранилище исходников: {run['raw_store_mb']:.1f} МБ")
+    print(f"   Время: {run['wall_seconds']:.1f} с всего, {run['loop_seconds']:.1f} с от старта сборщика")
+    print(f"   Скорость: {run['points_per_second']:.2f} точек/с, {run['views_per_second']:.2f} видов/с")
+    print(f"   CPU: {run['cpu_seconds']:.1f} с ({run['cpu_seconds'] / max(run['wall_seconds'], 1e-9):.2f} ядра в среднем), "
+          f"пиковый RSS: {run['peak_rss_mb']:.0f} МБ (основной процесс), {run['peak_rss_workers_mb']:.0f} МБ (самый большой дочерний)")
+    print(f"   Вызовы API: поиск {calls['find_panorama']}, по ID {calls['find_panorama_by_id']}, "
+          f"загрузки {calls['download_panorama']}, ошибок {calls['errors']}")
+    top = sorted(run["stages"].items(), key=lambda item: -item[1]["sum_seconds"])[:6]
+    print("   Стадии (всего, с / p95, мс): " + ", ".join(f"{name} {s['sum_seconds']:.1f}/{s['p95_seconds'] * 1000:.0f}" for name, s in top))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк mainn.py с локальной заменой API Яндекса.")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--csv", default=os.path.join(REPO_ROOT, "almaty_roads.csv"), help="Исходный CSV с дорогами.")
+    parser.add_argument("--segments", type=int, default=40, help="Сколько сегментов взять из CSV (по умолчанию 40).")
+    parser.add_argument("--offset", type=int, default=0, help="С какого сегмента начинать срез.")
+    parser.add_argument("--years", default="2023", help="Годы для mainn.py --years (по умолчанию 2023).")
+    parser.add_argument("--workers", type=int, default=8, help="--workers для mainn.py (по умолчанию 8).")
+    parser.add_argument("--image-workers", type=int, default=max(1, os.cpu_count() or 1), help="--image-workers для mainn.py.")
+    parser.add_argument("--rps", type=float, default=1000.0, help="--rps для mainn.py; по умолчанию лимит фактически снят.")
+    parser.add_argument("--latency-ms", type=float, default=80.0, help="Медианная задержка поиска панорамы, мс.")
+    parser.add_argument("--download-latency-ms", type=float, default=300.0, help="Медианная задержка загрузки панорамы, мс.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Доля запросов, завершающихся ошибкой (0..1).")
+    parser.add_argument("--coverage", type=float, default=0.85, help="Доля мест, где есть панорама.")
+    parser.add_argument("--pano-size", default="4096x2048", help="Размер синтетической панорамы, ШxВ.")
+    parser.add_argument("--raw-store", default="full", help="--raw-store для mainn.py: full, band или roi (по умолчанию full).")
+    parser.add_argument("--raw-zoom", type=int, default=0, help="--raw-zoom для mainn.py (по умолчанию 0).")
+    parser.add_argument("--raw-store-gb", type=float, default=0.0, help="--raw-store-gb для mainn.py (по умолчанию 0 - без лимита).")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--warm", action="store_true", help="Второй прогон с новым output/, но с кэшами первого (temp_panoramas).")
+    parser.add_argument("--micro-repeat", type=int, default=5, help="Повторов для замеров отдельных функций, 0 - пропустить.")
+    parser.add_argument("--json", default=None, help="Сохранить результаты в JSON для сравнения между версиями.")
+    parser.add_argument("--keep", action="store_true", help="Не удалять рабочую папку (логи, output, кэши).")
+    args, rest = parser.parse_known_args()
+    if args.child:
+        child_main(args, rest[1:] if rest[:1] == ["--"] else rest); return
+
+    workdir = tempfile.mkdtemp(prefix="bench_pipeline_")
+    segments = write_slice(args.csv, os.path.join(workdir, "almaty_roads.csv"), args.segments, args.offset)
+    print(f"🧪 Срез: {segments} сегментов из {os.path.basename(args.csv)}, годы {args.years}, воркеров {args.workers}, "
+          f"процессов для изображений {args.image_workers}; задержка {args.latency_ms:g}/{args.download_latency_ms:g} мс, "
+          f"ошибок {args.error_rate:.0%}, панорама {args.pano_size}, исходники {args.raw_store} (зум {args.raw_zoom})")
+    results = {"config": {k: v for k, v in vars(args).items() if k not in ("child", "keep")}, "runs": []}
+    try:
+        results["runs"].append(run_collector(workdir, args, "cold"))
+        print_run(results["runs"][-1])
+        if args.warm:
+            shutil.rmtree(os.path.join(workdir, "output"), ignore_errors=True)
+            results["runs"].append(run_collector(workdir, args, "warm"))
+            print_run(results["runs"][-1])
+        if args.micro_repeat > 0:
+            results["micro"] = micro_benchmarks(args)
+            print("\n⏱️  Отдельные функции (медиана, мс):")
+            for name, value in results["micro"].items(): print(f"   {name:<26}{value:>10.2f}")
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f: json.dump(results, f, ensure_ascii=False, indent=2)
+            print(f"\n✅ Результаты сохранены: {args.json}")
+    finally:
+        if args.keep: print(f"📁 Рабочая папка: {workdir}")
+        else: shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Микробенчмарк нарезки панорамы: прежний путь через py360convert.e2p против кэшированных
+таблиц cv2.remap из projection.py. Заодно сверяет результат с эталоном.
+
+    python benchmarks/bench_projection.py                       # синтетическая панорама 7168x3584
+    python benchmarks/bench_projection.py --image temp_panoramas/<id>.jpg --repeat 10
+"""
+import os
+import sys
+import time
+import argparse
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from projection import crop_panorama_to_roi, crop_panorama_to_roi_e2p, remap_tables  # noqa: E402
+
+# Допуск сверки с e2p. С py360convert 1.x (тоже cv2.remap с картами CV_16SC2) результат совпадает
+# побитово; допуск покрывает старые версии, где e2p интерполирует через scipy map_coordinates
+MAX_ABS_DIFF = 8
+MEAN_ABS_DIFF = 0.5
+
+
+def synthetic_panorama(width: int, height: int) -> np.ndarray:
+    rng = np.random.default_rng(0)
+    small = rng.integers(0, 256, (height // 64, width // 64, 3), dtype=np.uint8)
+    img = cv2.resize(small, (width, height), interpolation=cv2.INTER_CUBIC)
+    noise = rng.integers(0, 16, (height, width, 3), dtype=np.uint8)
+    return cv2.add(img, noise)
+
+
+def timed(fn, img, year, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(img, year)
+        timings.append(time.perf_counter() - start)
+    return result, timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк e2p против кэшированного cv2.remap.")
+    parser.add_argument("--image", default=None, help="Путь к реальной панораме (по умолчанию синтетическая).")
+    parser.add_argument("--size", default="7168x3584", help="Размер синтетической панорамы, ШxВ.")
+    parser.add_argument("--year", default="2023", help="Год, определяющий профиль обрезки.")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.image:
+        img = cv2.imread(args.image)
+        if img is None: sys.exit(f"❌ Не удалось прочитать {args.image}")
+    else:
+        width, height = (int(x) for x in args.size.lower().split("x"))
+        img = synthetic_panorama(width, height)
+    print(f"Панорама {img.shape[1]}x{img.shape[0]}, профиль года {args.year}, повторов {args.repeat}")
+
+    reference, e2p_times = timed(crop_panorama_to_roi_e2p, img, args.year, args.repeat)
+    remap_tables.cache_clear()
+    start = time.perf_counter()
+    crop_panorama_to_roi(img, args.year)
+    cold = time.perf_counter() - start
+    result, remap_times = timed(crop_panorama_to_roi, img, args.year, args.repeat)
+
+    print(f"e2p:                     медиана {np.median(e2p_times) * 1000:8.1f} мс")
+    print(f"remap (первый вызов):    {cold * 1000:8.1f} мс (включая построение таблиц)")
+    print(f"remap (таблицы в кэше):  медиана {np.median(remap_times) * 1000:8.1f} мс, "
+          f"ускорение x{np.median(e2p_times) / np.median(remap_times):.1f}")
+
+    ok = True
+    for ref_view, view in zip(reference, result):
+        if ref_view["image"].shape != view["image"].shape:
+            print(f"❌ {view['label']}: размер {view['image'].shape} != {ref_view['image'].shape}")
+            ok = False
+            continue
+        diff = np.abs(ref_view["image"].astype(np.int16) - view["image"].astype(np.int16))
+        within = diff.max() <= MAX_ABS_DIFF and diff.mean() <= MEAN_ABS_DIFF
+        ok &= bool(within)
+        print(f"{'✅' if within else '❌'} {view['label']}: макс. расхождение {diff.max()}, среднее {diff.mean():.4f} "
+              f"(допуск {MAX_ABS_DIFF} / {MEAN_ABS_DIFF})")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""
+Локальная замена streetlevel.yandex для офлайн-бенчмарков: детерминированные синтетические
+панорамы вместо живого API.
+
+Ответ зависит только от seed и координат: точки в одной ячейке ~pano_spacing_m получают одну
+и ту же панораму, как у настоящих съемок, у каждой панорамы есть список исторических (без
+image_sizes, как в реальном API, поэтому сборщик дозапрашивает их по ID), три уровня зума
+и тайлы 256x256 для режима --raw-store roi. Задержка ответа и доля ошибок настраиваются; ошибка решается по (запрос, номер попытки), поэтому повторный
+запрос может пройти, а прогон с тем же seed повторяется.
+"""
+import math
+import time
+import random
+import hashlib
+import threading
+from datetime import datetime
+from json import JSONDecodeError
+from typing import Dict, Optional, Tuple
+
+import cv2
+import numpy as np
+import requests
+from streetlevel import util as streetlevel_util
+from streetlevel import yandex
+from streetlevel.dataclasses import Size
+from streetlevel.yandex.panorama import YandexPanorama
+
+HISTORY_YEARS = tuple(range(2013, 2023))
+ZOOM_LEVELS = 3
+TILE_SIZE = 256
+
+
+class FakeYandex:
+    def __init__(self, seed: int = 0, latency_ms: float = 80.0, download_latency_ms: float = 300.0,
+                 error_rate: float = 0.0, coverage: float = 0.85, history_rate: float = 0.5,
+                 pano_size: Tuple[int, int] = (4096, 2048), latest_year: int = 2023, pano_spacing_m: float = 20.0):
+        self.seed = seed
+        self.latency_ms = latency_ms
+        self.download_latency_ms = download_latency_ms
+        self.error_rate = error_rate
+        self.coverage = coverage
+        self.history_rate = history_rate
+        self.pano_size = pano_size
+        self.latest_year = latest_year
+        self.pano_spacing_m = pano_spacing_m
+        self.calls: Dict[str, int] = {"find_panorama": 0, "find_panorama_by_id": 0, "download_panorama": 0, "errors": 0}
+        self._attempts: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def _rng(self, *key) -> random.Random:
+        digest = hashlib.sha1(repr((self.seed,) + key).encode()).digest()
+        return random.Random(int.from_bytes(digest[:8], "big"))
+
+    def _call(self, kind: str, key: str, latency_ms: float) -> None:
+        """Учет вызова, задержка с разбросом и, с вероятностью error_rate, ошибка как у живого API."""
+        with self._lock:
+            self.calls[kind] += 1
+            attempt = self._attempts.get(key, 0)
+            self._attempts[key] = attempt + 1
+        rng = self._rng(kind, key, attempt)
+        if latency_ms > 0: time.sleep(rng.lognormvariate(math.log(latency_ms / 1000.0), 0.5))
+        if rng.random() < self.error_rate:
+            with self._lock: self.calls["errors"] += 1
+            if rng.random() < 0.5: raise JSONDecodeError("Expecting value", "", 0)
+            raise requests.ConnectionError(f"Fake connection reset ({kind})")
+
+    def _pano_id(self, cell: Tuple[int, int], year: int) -> str:
+        # Ячейка зашита в ID, чтобы find_panorama_by_id восстанавливал координаты в любом процессе,
+        # в том числе когда поиск по точке пришел из кэша прошлого прогона
+        return f"fake{self.seed}s{cell[0]}x{cell[1]}_{int(datetime(year, 6, 1).timestamp())}"
+
+    def _cell_position(self, cell: Tuple[int, int]) -> Tuple[float, float]:
+        """Центр ячейки: координаты панорамы, как если бы машина проехала ровно по нему."""
+        lat = cell[0] * self.pano_spacing_m / 111320.0
+        return lat, cell[1] * self.pano_spacing_m / (111320.0 * math.cos(math.radians(lat)))
+
+    def _make_pano(self, pano_id: str, lat: float, lon: float, year: int, full: bool) -> YandexPanorama:
+        width, height = self.pano_size
+        sizes = [Size(width >> zoom, height >> zoom) for zoom in range(ZOOM_LEVELS)]
+        return YandexPanorama(id=pano_id, lat=lat, lon=lon, heading=0.0, image_id=pano_id, date=datetime(year, 6, 1),
+                              tile_size=Size(TILE_SIZE, TILE_SIZE), image_sizes=sizes if full else None)
+
+    def find_panorama(self, lat: float, lon: float, session=None) -> Optional[YandexPanorama]:
+        row = round(lat * 111320.0 / self.pano_spacing_m)
+        cell = (row, round(lon * 111320.0 * math.cos(math.radians(row * self.pano_spacing_m / 111320.0)) / self.pano_spacing_m))
+        self._call("find_panorama", f"{lat:.7f},{lon:.7f}", self.latency_ms)
+        rng = self._rng("cell", cell)
+        if rng.random() >= self.coverage: return None
+        pano_lat, pano_lon = self._cell_position(cell)
+        latest = self._make_pano(self._pano_id(cell, self.latest_year), pano_lat, pano_lon, self.latest_year, True)
+        latest.historical = [self._make_pano(self._pano_id(cell, year), pano_lat, pano_lon, year, False)
+                             for year in HISTORY_YEARS if year < self.latest_year and rng.random() < self.history_rate]
+        return latest
+
+    def find_panorama_by_id(self, panoid: str, session=None) -> Optional[YandexPanorama]:
+        self._call("find_panorama_by_id", panoid, self.latency_ms)
+        try:
+            cell_part, timestamp = panoid[len(f"fake{self.seed}s"):].rsplit("_", 1)
+            cell = tuple(int(v) for v in cell_part.split("x"))
+        except ValueError:
+            return None
+        year = datetime.fromtimestamp(int(timestamp)).year
+        return self._make_pano(panoid, *self._cell_position(cell), year, True)
+
+    def _image(self, pano_id: str, zoom: int) -> np.ndarray:
+        img = synthetic_panorama(pano_id, *self.pano_size)
+        if zoom == 0: return img
+        return cv2.resize(img, (img.shape[1] >> zoom, img.shape[0] >> zoom), interpolation=cv2.INTER_AREA)
+
+    def download_panorama(self, pano: YandexPanorama, path: str, zoom: int = 0, pil_args: dict = None) -> None:
+        zoom = max(0, min(zoom, ZOOM_LEVELS - 1))
+        # Загрузка упирается в канал: задержка пропорциональна числу пикселей
+        self._call("download_panorama", pano.id, self.download_latency_ms / 4 ** zoom)
+        cv2.imwrite(path, self._image(pano.id, zoom))
+
+    def download_tiles(self, tile_list: list, headers: dict = None) -> Dict[Tuple[int, int], bytes]:
+        """Замена streetlevel.util.download_tiles: тайлы одной панорамы по URL вида .../{image_id}/{zoom}.{x}.{y}."""
+        image_id, name = tile_list[0].url.rsplit("/", 2)[-2:]
+        zoom = int(name.split(".")[0])
+        img = self._image(image_id, zoom)
+        total = -(-img.shape[0] // TILE_SIZE) * -(-img.shape[1] // TILE_SIZE)
+        self._call("download_panorama", image_id, self.download_latency_ms / 4 ** zoom * len(tile_list) / total)
+        return {(t.x, t.y): cv2.imencode(".jpg", img[t.y * TILE_SIZE:(t.y + 1) * TILE_SIZE, t.x * TILE_SIZE:(t.x + 1) * TILE_SIZE])[1].tobytes()
+                for t in tile_list}
+
+    def install(self) -> None:
+        """
+        Подменяет функции streetlevel.yandex и загрузку тайлов в streetlevel.util; mainn.py и raw_store.py
+        обращаются к ним через модули, поэтому подмена видна сразу.
+        """
+        yandex.find_panorama = self.find_panorama
+        yandex.find_panorama_by_id = self.find_panorama_by_id
+        yandex.download_panorama = self.download_panorama
+        streetlevel_util.download_tiles = self.download_tiles
+
+
+def synthetic_panorama(pano_id: str, width: int, height: int) -> np.ndarray:
+    """Гладкая случайная текстура с шумом: JPEG и pHash ведут себя примерно как на реальных снимках."""
+    rng = np.random.default_rng(int(hashlib.sha1(pano_id.encode()).hexdigest()[:8], 16))
+    small = rng.integers(0, 256, (max(1, height // 64), max(1, width // 64), 3), dtype=np.uint8)
+    img = cv2.resize(small, (width, height), interpolation=cv2.INTER_CUBIC)
+    return cv2.add(img, rng.integers(0, 16, (height, width, 3), dtype=np.uint8))
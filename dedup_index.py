@@ -0,0 +1,183 @@
+"""
+Индекс pHash для поиска почти-дубликатов изображений.
+
+Отвечает на вопрос "есть ли в индексе хэш на расстоянии Хэмминга <= k?" быстрее линейного
+перебора: multi-index hashing. 64-битный хэш режется на k+1 непересекающихся кусков; если два
+хэша отличаются не больше чем в k битах, хотя бы один кусок у них совпадает точно (принцип
+Дирихле). Для каждого куска хранится отсортированный массив значений, кандидаты ищутся через
+searchsorted и проверяются точным подсчетом расстояния. Сами хэши лежат в numpy-массиве uint64.
+
+Запуск как скрипта ищет дубликаты между годами по уже собранным данным:
+
+    python dedup_index.py --output output --threshold 4
+"""
+import os
+import csv
+import glob
+import sqlite3
+import argparse
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from state_store import MASK_64
+
+DEFAULT_THRESHOLD = 4
+HASH_BITS = 64
+
+if hasattr(np, "bitwise_count"):
+    def _popcount(values: np.ndarray) -> np.ndarray:
+        return np.bitwise_count(values)
+else:  # numpy < 2.0
+    _POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+    def _popcount(values: np.ndarray) -> np.ndarray:
+        return _POPCOUNT_TABLE[values.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+def hash_to_int(image_hash: str) -> int:
+    """Hex-строка pHash (str(imagehash.phash(...))) -> 64-битное целое."""
+    return int(image_hash, 16)
+
+
+class HashIndex:
+    """
+    Индекс почти-дубликатов по 64-битным pHash с порогом threshold (0 - только точные совпадения).
+    Новые хэши копятся в небольшом буфере и периодически вливаются в отсортированные таблицы,
+    поэтому вставка амортизированно дешевая. Рядом с каждым хэшем хранится целочисленная метка
+    (например, ID вида) для отчетов.
+    Выигрыш над линейным перебором есть при пороге примерно до 6 бит; при большем пороге куски
+    становятся короткими, и поиск сам переходит на векторный полный проход.
+    """
+    def __init__(self, threshold: int = DEFAULT_THRESHOLD):
+        if not 0 <= threshold < HASH_BITS:
+            raise ValueError(f"Порог должен быть в диапазоне 0..{HASH_BITS - 1}, получено: {threshold}")
+        self.threshold = threshold
+        n_chunks = threshold + 1
+        bounds = np.linspace(0, HASH_BITS, n_chunks + 1).astype(int)
+        self._chunks = [(np.uint64(lo), np.uint64((1 << (hi - lo)) - 1)) for lo, hi in zip(bounds, bounds[1:])]
+        self._hashes = np.empty(0, dtype=np.uint64)
+        self._labels = np.empty(0, dtype=np.int64)
+        self._tables = [(np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.int64)) for _ in self._chunks]
+        self._pending_hashes: List[int] = []
+        self._pending_labels: List[int] = []
+
+    def __len__(self) -> int:
+        return len(self._hashes) + len(self._pending_hashes)
+
+    def _rebuild(self) -> None:
+        if self._pending_hashes:
+            self._hashes = np.concatenate([self._hashes, np.array(self._pending_hashes, dtype=np.uint64)])
+            self._labels = np.concatenate([self._labels, np.array(self._pending_labels, dtype=np.int64)])
+            self._pending_hashes, self._pending_labels = [], []
+        tables = []
+        for shift, mask in self._chunks:
+            keys = (self._hashes >> shift) & mask
+            order = np.argsort(keys, kind="stable")
+            tables.append((keys[order], order))
+        self._tables = tables
+
+    def add_many(self, hashes: Iterable[int], labels: Optional[Iterable[int]] = None) -> None:
+        hashes = np.fromiter(hashes, dtype=np.uint64)
+        labels = np.full(len(hashes), -1, dtype=np.int64) if labels is None else np.fromiter(labels, dtype=np.int64, count=len(hashes))
+        self._pending_hashes.extend(int(h) for h in hashes)
+        self._pending_labels.extend(int(label) for label in labels)
+        self._rebuild()
+
+    def add(self, image_hash: int, label: int = -1) -> None:
+        self._pending_hashes.append(image_hash)
+        self._pending_labels.append(label)
+        # Буфер вливается в таблицы, когда дорастает до 1/8 индекса: сортировка амортизируется
+        if len(self._pending_hashes) >= max(1024, len(self._hashes) // 8):
+            self._rebuild()
+
+    def find(self, image_hash: int, threshold: Optional[int] = None) -> List[Tuple[int, int]]:
+        """Все (метка, расстояние) на расстоянии <= threshold (по умолчанию порог индекса)."""
+        threshold = self.threshold if threshold is None else min(threshold, self.threshold)
+        query = np.uint64(image_hash)
+        candidates = []
+        for (shift, mask), (keys, order) in zip(self._chunks, self._tables):
+            key = (query >> shift) & mask
+            lo, hi = np.searchsorted(keys, key, side="left"), np.searchsorted(keys, key, side="right")
+            if hi > lo: candidates.append(order[lo:hi])
+        matches = []
+        if sum(len(c) for c in candidates) > len(self._hashes) // 32:
+            # При большом пороге куски короткие и кандидатов слишком много: полный векторный проход дешевле
+            distances = _popcount(self._hashes ^ query)
+            close = np.nonzero(distances <= threshold)[0]
+            matches.extend(zip(self._labels[close].tolist(), distances[close].tolist()))
+        elif candidates:
+            positions = np.concatenate(candidates)
+            distances = _popcount(self._hashes[positions] ^ query)
+            within = distances <= threshold
+            # Один и тот же хэш может совпасть по нескольким кускам: дубли убираются уже после фильтра
+            close, first = np.unique(positions[within], return_index=True)
+            matches.extend(zip(self._labels[close].tolist(), distances[within][first].tolist()))
+        if self._pending_hashes:
+            distances = _popcount(np.array(self._pending_hashes, dtype=np.uint64) ^ query)
+            for i in np.nonzero(distances <= threshold)[0]:
+                matches.append((self._pending_labels[i], int(distances[i])))
+        return matches
+
+    def nearest_distance(self, image_hash: int) -> Optional[int]:
+        """Расстояние до ближайшего хэша в пределах порога или None, если таких нет."""
+        matches = self.find(image_hash)
+        return min(distance for _, distance in matches) if matches else None
+
+    def contains_near(self, image_hash: int) -> bool:
+        return self.nearest_distance(image_hash) is not None
+
+
+def load_year_hashes(state_path: str) -> Tuple[List[int], List[int]]:
+    """
+    (хэши, ID видов) из журнала года state.sqlite; у хэшей из старого state.pkl ID вида -1.
+    Журнал открывается только на чтение: он может принадлежать идущему сейчас прогону другого года.
+    """
+    conn = sqlite3.connect(f"{Path(state_path).resolve().as_uri()}?mode=ro", uri=True)
+    try:
+        rows = conn.execute("SELECT hash, COALESCE(view_id, -1) FROM phashes").fetchall()
+    finally:
+        conn.close()
+    return [row[0] & MASK_64 for row in rows], [row[1] for row in rows]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Поиск почти-дубликатов изображений между годами.")
+    parser.add_argument("--output", default="output", help="Корневая папка с результатами по годам.")
+    parser.add_argument("--threshold", type=int, default=DEFAULT_THRESHOLD, help=f"Максимальное расстояние Хэмминга (по умолчанию {DEFAULT_THRESHOLD}).")
+    parser.add_argument("--report", default=None, help="CSV для списка найденных пар (по умолчанию только сводка).")
+    args = parser.parse_args()
+
+    years = {}
+    for state_path in sorted(glob.glob(os.path.join(args.output, "*", "state.sqlite"))):
+        year = os.path.basename(os.path.dirname(state_path))
+        years[year] = load_year_hashes(state_path)
+        print(f"📅 {year}: {len(years[year][0])} хэшей")
+    if len(years) < 2:
+        print("ℹ️ Для поиска дубликатов между годами нужны результаты хотя бы за два года."); return
+
+    pairs = []
+    indexes = {}
+    for year, (hashes, view_ids) in years.items():
+        # Каждый год сверяется со всеми предыдущими, так каждая пара лет проверяется один раз
+        for other_year, index in indexes.items():
+            found = 0
+            for image_hash, view_id in zip(hashes, view_ids):
+                for other_view_id, distance in index.find(image_hash):
+                    pairs.append((year, view_id, other_year, other_view_id, distance))
+                    found += 1
+            print(f"🔁 {year} против {other_year}: {found} пар почти-дубликатов (порог {args.threshold})")
+        indexes[year] = HashIndex(args.threshold)
+        indexes[year].add_many(hashes, view_ids)
+
+    if args.report:
+        with open(args.report, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(["Year", "ID", "OtherYear", "OtherID", "Distance"])
+            writer.writerows(pairs)
+        print(f"✅ Список пар сохранен: {args.report}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,36 @@
 import os
 import csv
+import html
+import json
 import folium
-from folium.plugins import MarkerCluster
+from folium.plugins import MarkerCluster, FastMarkerCluster
+from branca.colormap import LinearColormap
 import argparse
+from roads import iter_segments, load_roads, simplify_path, cell_key, cell_bounds
+
+MAP_MODES = ["fast", "grid", "markers"]
 
 # --- Настройка ---
 parser = argparse.ArgumentParser(description="Генератор карты по логам.")
 parser.add_argument("year", type=int, nargs='?', default=None, help="Год для визуализации (например, 2023). Если не указан, будет запрошен.")
+parser.add_argument("--no-road-cache", action="store_true", help="Разобрать CSV с дорогами заново, не используя бинарный кэш геометрии.")
+parser.add_argument("--mode", choices=MAP_MODES, default="fast",
+                    help="fast - кластеры, которые строит браузер, и дороги одним GeoJSON; grid - покрытие по ячейкам сетки; "
+                         "markers - прежний режим с отдельным маркером на каждую строку лога (по умолчанию fast).")
+parser.add_argument("--grid-m", type=float, default=250.0, help="Размер ячейки сетки в режиме grid, м (по умолчанию 250).")
+parser.add_argument("--simplify-m", type=float, default=2.0, help="Допуск упрощения геометрии дорог в режимах fast и grid, м; 0 - без упрощения (по умолчанию 2).")
 args = parser.parse_args()
 
 if args.year:
     YEAR = str(args.year)
 else:
     YEAR = input("➡️ Введите год для визуализации (например, 2023): ")
-    
+
 if not YEAR.isdigit() or not (2010 < int(YEAR) < 2030):
     print(f"❌ Некорректный год: {YEAR}. Выход.")
     exit()
 
-print(f"🗺️ Генерируем карту для {YEAR} года...")
+print(f"🗺️ Генерируем карту для {YEAR} года (режим {args.mode})...")
 
 output_dir = f"output/{YEAR}"
 input_csv = "almaty_roads.csv" # Путь к исходному CSV с дорогами
@@ -26,76 +38,196 @@ log_file = os.path.join(output_dir, f"metadata_{YEAR}.csv")
 bad_addresses_file = os.path.join(output_dir, f"no_panorama_addresses_{YEAR}.csv")
 map_output = os.path.join(output_dir, f"map_{YEAR}.html")
 
-# --- Создание карты ---
-# Примерный центр для Алматы
-map_center = [43.2389, 76.8512] 
-road_map = folium.Map(location=map_center, zoom_start=12, tiles='OpenStreetMap')
+# Кластер строится в браузере из компактного массива строк [lat, lon, индекс дороги, ObjectID, виды]
+# вместо отдельного JS-объекта на каждый маркер; названия дорог передаются один раз, попап собирается при клике
+FAST_MARKER_CALLBACK = """(function () {
+    var roads = %(roads)s;
+    return function (row) {
+        var marker = L.circleMarker(new L.LatLng(row[0], row[1]), {radius: 6, weight: 1, color: "%(color)s", fillColor: "%(color)s", fillOpacity: 0.8});
+        marker.bindPopup(function () {
+            var text = roads[row[2]];
+            if (row.length > 3) text += "<br>ObjectID: " + row[3] + "<br>Виды: " + row[4];
+            return text + "<br>Статус: %(status)s";
+        });
+        return marker;
+    };
+})()"""
 
-# --- Нанесение слоев ---
-# 1. Базовый слой всех дорог
-try:
-    with open(input_csv, mode="r", encoding="utf-8") as f:
-        reader = csv.DictReader(f)
-        base_roads_layer = folium.FeatureGroup(name="Все дороги (из файла)", show=True).add_to(road_map)
-        for row in reader:
-            geom = (row.get("geometry_wkt") or "").strip()
-            # Простая регулярка для парсинга WKT
-            import re
-            coords_pairs = re.findall(r"([-\d\.]+)\s+([-\d\.]+)", geom)
-            if coords_pairs:
-                path = [(float(lat), float(lon)) for lon, lat in coords_pairs]
-                folium.PolyLine(path, color="gray", weight=2, opacity=0.7).add_to(base_roads_layer)
-    print("✅ Базовый слой дорог нанесен.")
-except FileNotFoundError:
-    print(f"⚠️ Исходный файл {input_csv} не найден. Базовый слой не будет построен.")
-
-# 2. Маркеры
-marker_cluster = MarkerCluster(name=f"Результаты {YEAR}").add_to(road_map)
-# Успешные точки
-try:
+
+def read_found_points():
+    """Успешные точки из лога: одна запись на панораму (в логе по строке на каждый вид)."""
+    points = {}
     with open(log_file, 'r', newline='', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        success_count = 0
-        for row in reader:
+        for row in csv.DictReader(f):
             try:
                 lat, lon = float(row['Latitude']), float(row['Longitude'])
-                popup_text = f"{row.get('RoadName', '')}<br>ObjectID: {row.get('ObjectID', 'N/A')}<br>Статус: Успех"
-                folium.Marker(
-                    location=[lat, lon], 
-                    popup=popup_text, 
-                    icon=folium.Icon(color="green", icon="check", prefix='fa')
-                ).add_to(marker_cluster)
-                success_count += 1
-            except (ValueError, KeyError):
+            except (ValueError, KeyError, TypeError):
                 continue
-    print(f"✅ Нанесено {success_count} успешных маркеров.")
-except FileNotFoundError:
-    print(f"ℹ️ Файл лога {os.path.basename(log_file)} не найден.")
+            point = points.setdefault(row.get('PanoID') or (lat, lon), {"lat": lat, "lon": lon, "road": row.get('RoadName', ''),
+                                                                       "object_id": row.get('ObjectID', 'N/A'), "views": []})
+            point["views"].append(row.get('View', ''))
+    return list(points.values())
 
-# Неудачные точки
-try:
+
+def read_missing_points():
+    points = []
     with open(bad_addresses_file, 'r', newline='', encoding='utf-8') as f:
-        reader = csv.reader(f)
-        fail_count = 0
-        for row in reader:
+        for row in csv.reader(f):
             try:
-                road_name, lat, lon = row[0], float(row[1]), float(row[2])
-                popup_text = f"{road_name}<br>Статус: Не найдено"
-                folium.Marker(
-                    location=[lat, lon], 
-                    popup=popup_text, 
-                    icon=folium.Icon(color="red", icon="times", prefix='fa')
-                ).add_to(marker_cluster)
-                fail_count += 1
+                points.append({"lat": float(row[1]), "lon": float(row[2]), "road": row[0]})
             except (ValueError, IndexError):
                 continue
-    print(f"✅ Нанесено {fail_count} маркеров без панорам.")
-except FileNotFoundError:
-    print(f"ℹ️ Файл лога {os.path.basename(bad_addresses_file)} не найден.")
+    return points
+
+
+def load_points(reader, file_path):
+    try:
+        return reader()
+    except FileNotFoundError:
+        print(f"ℹ️ Файл лога {os.path.basename(file_path)} не найден.")
+        return []
+
+
+def add_roads_geojson(road_map):
+    """Все дороги одним объектом GeoJSON: упрощенная геометрия, координаты округлены до ~10 см."""
+    table = load_roads(input_csv, use_cache=not args.no_road_cache)
+    lines, vertices = [], 0
+    for i in range(len(table)):
+        coords = simplify_path(table.segment_coords(i), args.simplify_m)
+        if len(coords) < 2: continue
+        vertices += len(coords)
+        lines.append([[round(lon, 6), round(lat, 6)] for lat, lon in coords.tolist()])
+    geojson = {"type": "Feature", "properties": {}, "geometry": {"type": "MultiLineString", "coordinates": lines}}
+    # smooth_factor: Leaflet дополнительно упрощает линии под текущий зум при отрисовке
+    folium.GeoJson(geojson, name="Все дороги (из файла)", smooth_factor=1.5,
+                   style_function=lambda _: {"color": "gray", "weight": 2, "opacity": 0.7}).add_to(road_map)
+    print(f"✅ Базовый слой дорог нанесен: {len(lines)} сегментов, {vertices} из {table.vertex_count} вершин после упрощения.")
+
+
+def add_legacy_layers(road_map):
+    """Прежний режим: отдельные PolyLine и Marker на каждую строку. Подходит только для небольших выборок."""
+    # 1. Базовый слой всех дорог
+    try:
+        # Геометрия берется из общего с mainn.py загрузчика: после первого запуска - из бинарного кэша
+        base_roads_layer = folium.FeatureGroup(name="Все дороги (из файла)", show=True).add_to(road_map)
+        for road in iter_segments(input_csv, use_cache=not args.no_road_cache):
+            folium.PolyLine(road["path"], color="gray", weight=2, opacity=0.7).add_to(base_roads_layer)
+        print("✅ Базовый слой дорог нанесен.")
+    except FileNotFoundError:
+        print(f"⚠️ Исходный файл {input_csv} не найден. Базовый слой не будет построен.")
+
+    # 2. Маркеры
+    marker_cluster = MarkerCluster(name=f"Результаты {YEAR}").add_to(road_map)
+    # Успешные точки
+    try:
+        with open(log_file, 'r', newline='', encoding='utf-8') as f:
+            reader = csv.DictReader(f)
+            success_count = 0
+            for row in reader:
+                try:
+                    lat, lon = float(row['Latitude']), float(row['Longitude'])
+                    popup_text = f"{row.get('RoadName', '')}<br>ObjectID: {row.get('ObjectID', 'N/A')}<br>Статус: Успех"
+                    folium.Marker(
+                        location=[lat, lon],
+                        popup=popup_text,
+                        icon=folium.Icon(color="green", icon="check", prefix='fa')
+                    ).add_to(marker_cluster)
+                    success_count += 1
+                except (ValueError, KeyError):
+                    continue
+        print(f"✅ Нанесено {success_count} успешных маркеров.")
+    except FileNotFoundError:
+        print(f"ℹ️ Файл лога {os.path.basename(log_file)} не найден.")
+
+    # Неудачные точки
+    try:
+        with open(bad_addresses_file, 'r', newline='', encoding='utf-8') as f:
+            reader = csv.reader(f)
+            fail_count = 0
+            for row in reader:
+                try:
+                    road_name, lat, lon = row[0], float(row[1]), float(row[2])
+                    popup_text = f"{road_name}<br>Статус: Не найдено"
+                    folium.Marker(
+                        location=[lat, lon],
+                        popup=popup_text,
+                        icon=folium.Icon(color="red", icon="times", prefix='fa')
+                    ).add_to(marker_cluster)
+                    fail_count += 1
+                except (ValueError, IndexError):
+                    continue
+        print(f"✅ Нанесено {fail_count} маркеров без панорам.")
+    except FileNotFoundError:
+        print(f"ℹ️ Файл лога {os.path.basename(bad_addresses_file)} не найден.")
+
+
+def add_fast_markers(road_map, found, missing):
+    layers = (
+        (found, f"Найдено {YEAR}", "green", "Успех",
+         lambda p: [html.escape(p['object_id']), html.escape(', '.join(p['views']))]),
+        (missing, f"Не найдено {YEAR}", "red", "Не найдено", lambda p: []),
+    )
+    for points, name, color, status, extra in layers:
+        road_index = {}
+        data = [[round(p["lat"], 6), round(p["lon"], 6), road_index.setdefault(p["road"], len(road_index)), *extra(p)] for p in points]
+        roads = json.dumps([html.escape(road) for road in road_index], ensure_ascii=False)
+        callback = FAST_MARKER_CALLBACK % {"roads": roads, "color": color, "status": status}
+        FastMarkerCluster(data, callback=callback, name=name, chunkedLoading=True).add_to(road_map)
+    print(f"✅ Нанесено {len(found)} панорам (успешных точек) и {len(missing)} точек без панорам.")
+
+
+def add_coverage_grid(road_map, found, missing):
+    """Покрытие по ячейкам сетки grid_m: доля точек, для которых найдена панорама."""
+    cells = {}
+    for points, index in ((found, 0), (missing, 1)):
+        # В логах могут повторяться координаты (например, после возобновления): считаются уникальные точки
+        for lat, lon in {(p["lat"], p["lon"]) for p in points}:
+            cells.setdefault(cell_key(lat, lon, args.grid_m), [0, 0])[index] += 1
+    colormap = LinearColormap(["#d7191c", "#fdae61", "#1a9641"], vmin=0, vmax=100, caption=f"Покрытие панорамами {YEAR}, %")
+    features = []
+    for key, (n_found, n_missing) in cells.items():
+        lat_min, lon_min, lat_max, lon_max = cell_bounds(key, args.grid_m)
+        ring = [[round(lon, 6), round(lat, 6)] for lat, lon in
+                ((lat_min, lon_min), (lat_min, lon_max), (lat_max, lon_max), (lat_max, lon_min), (lat_min, lon_min))]
+        coverage = round(100.0 * n_found / (n_found + n_missing), 1)
+        features.append({"type": "Feature", "geometry": {"type": "Polygon", "coordinates": [ring]},
+                         "properties": {"coverage": coverage, "found": n_found, "missing": n_missing}})
+    folium.GeoJson(
+        {"type": "FeatureCollection", "features": features}, name=f"Покрытие {YEAR} (ячейки {args.grid_m:g} м)",
+        style_function=lambda feature: {"fillColor": colormap(feature["properties"]["coverage"]), "fillOpacity": 0.6,
+                                        "color": "#555555", "weight": 0.5},
+        tooltip=folium.GeoJsonTooltip(fields=["coverage", "found", "missing"], aliases=["Покрытие, %", "Найдено", "Не найдено"])
+    ).add_to(road_map)
+    colormap.add_to(road_map)
+    total_found, total_missing = len({(p["lat"], p["lon"]) for p in found}), len({(p["lat"], p["lon"]) for p in missing})
+    if total_found + total_missing:
+        print(f"✅ Нанесено {len(features)} ячеек, общее покрытие {100.0 * total_found / (total_found + total_missing):.1f}%.")
+
+
+# --- Создание карты ---
+# Примерный центр для Алматы
+map_center = [43.2389, 76.8512]
+# Canvas вместо SVG: тысячи линий и кругов не создают по DOM-элементу на каждый объект
+road_map = folium.Map(location=map_center, zoom_start=12, tiles='OpenStreetMap', prefer_canvas=args.mode != "markers")
+
+# --- Нанесение слоев ---
+if args.mode == "markers":
+    add_legacy_layers(road_map)
+else:
+    try:
+        add_roads_geojson(road_map)
+    except FileNotFoundError:
+        print(f"⚠️ Исходный файл {input_csv} не найден. Базовый слой не будет построен.")
+    found_points = load_points(read_found_points, log_file)
+    missing_points = load_points(read_missing_points, bad_addresses_file)
+    if args.mode == "fast":
+        add_fast_markers(road_map, found_points, missing_points)
+    else:
+        add_coverage_grid(road_map, found_points, missing_points)
 
 # --- Сохранение ---
 folium.LayerControl().add_to(road_map)
 road_map.save(map_output)
 
 print("-" * 50)
-print(f"✅ Карта успешно сгенерирована и сохранена: {os.path.abspath(map_output)}")
\ No newline at end of file
+print(f"✅ Карта успешно сгенерирована и сохранена: {os.path.abspath(map_output)} ({os.path.getsize(map_output) / 1e6:.1f} МБ)")
@@ -0,0 +1,169 @@
+import os
+import time
+import signal
+import threading
+import weakref
+import multiprocessing
+from concurrent.futures import CancelledError, Future, ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Dict, List, Optional, Tuple
+
+import cv2
+import imagehash
+from PIL import Image
+
+from projection import crop_panorama_to_roi
+from raw_store import BAND_JPEG_QUALITY, RawEntry, crop_to_band
+
+
+class ImagePoolError(Exception):
+    """Пул обработки изображений сломан или не ответил вовремя; точку нужно повторить."""
+
+
+def _init_worker() -> None:
+    # Ctrl+C обрабатывает основной процесс; воркеры просто останавливаются вместе с пулом
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # imagehash.phash импортирует scipy лениво, при первом вызове: делаем это до первой задачи
+    import scipy.fftpack  # noqa: F401
+
+
+def _noop() -> None:
+    pass
+
+
+def write_band(img, year: str, band_to: Tuple[str, int, int]) -> Optional[Tuple[int, int]]:
+    """
+    Записывает полосу ROI полной панорамы в band_to = (путь, ширина и высота тайла).
+    Возвращает (первая строка полосы, высота полной панорамы) или None, если файл занят.
+    """
+    path, tile_w, tile_h = band_to
+    band, row_start = crop_to_band(img, year, tile_w, tile_h)
+    # Ту же полосу может параллельно писать другая точка: файл подменяется целиком
+    tmp_path = f"{path[:-len('.jpg')]}.{os.getpid()}.part.jpg"
+    cv2.imwrite(tmp_path, band, [cv2.IMWRITE_JPEG_QUALITY, BAND_JPEG_QUALITY])
+    try: os.replace(tmp_path, path)
+    except OSError:
+        os.remove(tmp_path)
+        return None
+    return row_start, img.shape[0]
+
+
+def render_views(raw_path: str, year: str, row_offset: int = 0, full_height: Optional[int] = None,
+                 band_to: Optional[Tuple[str, int, int]] = None) -> Tuple[Optional[List[dict]], Dict[str, float], Optional[Tuple[int, int]]]:
+    """
+    CPU-часть обработки панорамы, выполняется в процессе пула: декодирование исходника,
+    нарезка на виды, pHash и кодирование JPEG. Возвращает ([{label, hash, jpeg}] или None,
+    если исходник не читается; время стадий в секундах; записанная полоса или None).
+    Имена файлов и ID назначает основной процесс.
+    row_offset и full_height задаются, если исходник - полоса ROI (см. raw_store); band_to - если
+    полную панораму нужно заменить полосой (режим band, см. write_band и RawPanoramaStore.put_band).
+    """
+    timings = {"decode": 0.0, "project": 0.0, "phash": 0.0, "encode": 0.0}
+    start = time.perf_counter()
+    img = cv2.imread(raw_path)
+    timings["decode"] = time.perf_counter() - start
+    if img is None: return None, timings, None
+    band = None
+    if band_to:
+        start = time.perf_counter()
+        band = write_band(img, year, band_to)
+        timings["crop_to_band"] = time.perf_counter() - start
+    start = time.perf_counter()
+    views = crop_panorama_to_roi(img, year, row_offset, full_height)
+    timings["project"] = time.perf_counter() - start
+    rendered = []
+    for view_data in views:
+        view_image = view_data["image"]
+        start = time.perf_counter()
+        pil_img = Image.fromarray(cv2.cvtColor(view_image, cv2.COLOR_BGR2RGB))
+        image_hash = str(imagehash.phash(pil_img))
+        timings["phash"] += time.perf_counter() - start
+        start = time.perf_counter()
+        ok, jpeg = cv2.imencode(".jpg", view_image)
+        timings["encode"] += time.perf_counter() - start
+        rendered.append({"label": view_data["label"], "hash": image_hash, "jpeg": jpeg.tobytes() if ok else None})
+    return rendered, timings, band
+
+
+class ImagePipeline:
+    """
+    Пул процессов для обработки изображений, отвязанный от сетевых потоков.
+
+    chain() подписывается на сетевой future точки: как только панорамы скачаны, задачи на их
+    обработку сразу уходят в пул, не дожидаясь, пока основной поток дойдет до этой точки.
+    Очередь пула ограничена окном точек "в полете" в основном цикле - это и есть backpressure.
+    Воркеры запускаются через spawn и сразу, при создании пула: форк из сетевого потока унаследовал
+    бы блокировки других потоков и соединений SQLite и мог зависнуть. Сломанный или зависший пул
+    перезапускается в result().
+    """
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._job_pools = weakref.WeakKeyDictionary()  # задача -> пул, в который она ушла
+        self._pool = self._start_pool()
+
+    def _start_pool(self) -> ProcessPoolExecutor:
+        pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"), initializer=_init_worker)
+        for _ in range(self.workers): pool.submit(_noop)
+        return pool
+
+    def _submit(self, *args) -> Future:
+        while True:
+            pool = self._pool
+            try:
+                job = pool.submit(render_views, *args)
+            except BrokenProcessPool as e:
+                job = Future()
+                job.set_exception(e)
+            except RuntimeError:
+                if pool is self._pool: raise
+                continue  # пул остановлен перезапуском между чтением и submit
+            self._job_pools[job] = pool
+            return job
+
+    def result(self, job: Future, timeout: float) -> Tuple[Optional[List[dict]], Dict[str, float], Optional[Tuple[int, int]]]:
+        """
+        Результат задачи пула не дольше timeout секунд. Если пул сломан или задача не успела,
+        пул, в который она ушла, заменяется новым (один раз на сбой), и поднимается ImagePoolError.
+        """
+        try:
+            return job.result(timeout=timeout)
+        except (BrokenProcessPool, CancelledError, TimeoutError) as e:
+            with self._lock:
+                if self._job_pools.get(job) is self._pool:
+                    old, self._pool = self._pool, self._start_pool()
+                    # Зависший воркер сам не завершится: задачи старого пула получат BrokenProcessPool
+                    for process in list((getattr(old, "_processes", None) or {}).values()): process.terminate()
+                    old.shutdown(wait=False, cancel_futures=True)
+            raise ImagePoolError(str(e) or type(e).__name__) from e
+
+    def chain(self, network_future: Future, raw_entry_for: Callable[[object], RawEntry]) -> Future:
+        """
+        Возвращает future с (found, notes, {год: future с видами}) поверх future от PanoramaFetcher.fetch.
+        raw_entry_for(pano) дает исходник панорамы в RawPanoramaStore.
+        """
+        chained = Future()
+
+        def on_network_done(f: Future) -> None:
+            try:
+                found, notes = f.result()
+                jobs = {}
+                for year, pano in found.items():
+                    raw = raw_entry_for(pano)
+                    band_to = (raw.band_path, pano.tile_size.x, pano.tile_size.y) if raw.band_path else None
+                    jobs[year] = self._submit(raw.path, year, raw.row_offset, raw.full_height, band_to)
+            except BaseException as e:
+                chained.set_exception(e)
+                return
+            chained.set_result((found, notes, jobs))
+
+        network_future.add_done_callback(on_network_done)
+        return chained
+
+    def shutdown(self) -> None:
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+def default_image_workers() -> int:
+    return max(1, os.cpu_count() or 1)
+
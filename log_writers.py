@@ -0,0 +1,131 @@
+import csv
+import io
+import os
+import threading
+import time
+from typing import List, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows: межпроцессная блокировка недоступна, остается блокировка потоков
+    fcntl = None
+
+
+class BufferedCsvWriter:
+    """
+    Долгоживущий писатель CSV-лога с буфером.
+
+    Строки копятся в памяти и сбрасываются одной записью, когда набирается flush_rows строк
+    или проходит flush_seconds с прошлого сброса. Запись защищена блокировкой потоков и
+    (на POSIX) flock на файле, поэтому строки от нескольких потоков и процессов не перемешиваются.
+    checkpoint() дополнительно делает fsync. При заданном parquet_dir строки дублируются в один
+    файл Parquet на сессию (нужен pyarrow): на каждом checkpoint() в него дописывается группа строк.
+    Пока сессия идет, имя файла начинается с "_", и pyarrow пропускает его при чтении папки;
+    close() дописывает футер и переименовывает файл. Parquet-копия сессии, прерванной сбоем,
+    теряется, CSV при этом остается полным.
+    """
+    def __init__(self, path: str, header: Optional[List[str]] = None, columns: Optional[List[str]] = None,
+                 flush_rows: int = 200, flush_seconds: float = 5.0, parquet_dir: Optional[str] = None):
+        self.path = path
+        self.columns = columns or header
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self._parquet_dir = parquet_dir
+        self._parquet_rows = []
+        self._parquet_writer = None
+        self._parquet_name = f"part-{time.strftime('%Y%m%d%H%M%S')}-{os.getpid()}.parquet"
+        if parquet_dir:
+            try:
+                import pyarrow  # noqa: F401
+                os.makedirs(parquet_dir, exist_ok=True)
+            except ImportError:
+                print(f"⚠️ pyarrow не установлен, Parquet-копия {os.path.basename(path)} отключена.")
+                self._parquet_dir = None
+        self._file = open(path, "a", newline="", encoding="utf-8")
+        if header and self._file.tell() == 0:
+            self._write_chunk([header])
+
+    def _write_chunk(self, rows: List[list]) -> None:
+        chunk = io.StringIO()
+        csv.writer(chunk).writerows(rows)
+        if fcntl: fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        try:
+            self._file.write(chunk.getvalue())
+            self._file.flush()
+        finally:
+            if fcntl: fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+
+    def _write_parquet(self) -> None:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        rows, self._parquet_rows = self._parquet_rows, []
+        records = [dict(zip(self.columns, row)) for row in rows]
+        if self._parquet_writer is None:
+            table = pa.Table.from_pylist(records)
+            # Колонки, пустые в первой группе, хранятся строками, чтобы схема подошла и следующим группам
+            schema = pa.schema([field.with_type(pa.string()) if pa.types.is_null(field.type) else field for field in table.schema])
+            self._parquet_writer = pq.ParquetWriter(os.path.join(self._parquet_dir, f"_{self._parquet_name}"), schema)
+        schema = self._parquet_writer.schema
+        text_columns = {field.name for field in schema if pa.types.is_string(field.type)}
+        records = [{key: str(value) if key in text_columns and value is not None else value for key, value in record.items()} for record in records]
+        self._parquet_writer.write_table(pa.Table.from_pylist(records, schema=schema))
+
+    def _flush_locked(self) -> None:
+        if self._buffer:
+            rows, self._buffer = self._buffer, []
+            self._write_chunk(rows)
+            if self._parquet_dir: self._parquet_rows.extend(rows)
+        self._last_flush = time.monotonic()
+
+    def write_row(self, row: list) -> None:
+        with self._lock:
+            self._buffer.append(row)
+            if len(self._buffer) >= self.flush_rows or time.monotonic() - self._last_flush >= self.flush_seconds:
+                self._flush_locked()
+
+    def maybe_flush(self) -> None:
+        """Сброс по времени для редко пишущихся логов; вызывается из основного цикла."""
+        with self._lock:
+            if self._buffer and time.monotonic() - self._last_flush >= self.flush_seconds:
+                self._flush_locked()
+
+    def flush(self) -> None:
+        with self._lock: self._flush_locked()
+
+    def checkpoint(self) -> None:
+        with self._lock:
+            self._flush_locked()
+            os.fsync(self._file.fileno())
+            if self._parquet_rows: self._write_parquet()
+
+    def close(self) -> None:
+        self.checkpoint()
+        self._file.close()
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+            os.replace(os.path.join(self._parquet_dir, f"_{self._parquet_name}"), os.path.join(self._parquet_dir, self._parquet_name))
+            self._parquet_writer = None
+
+
+def tail_csv_rows(path: str, count: int, tail_bytes: int = 65536) -> List[List[str]]:
+    """Последние count непустых строк CSV без чтения всего файла."""
+    try:
+        with open(path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            f.seek(max(0, size - tail_bytes))
+            tail = f.read().decode("utf-8", errors="ignore")
+    except FileNotFoundError:
+        return []
+    lines = [line for line in tail.splitlines() if line.strip()]
+    if size > tail_bytes: lines = lines[1:]  # первая строка хвоста может быть обрезана
+    return list(csv.reader(lines[-count:])) if count > 0 else []
+
+
+def last_csv_row(path: str, tail_bytes: int = 65536) -> Optional[List[str]]:
+    """Последняя непустая строка CSV без чтения всего файла."""
+    rows = tail_csv_rows(path, 1, tail_bytes)
+    return rows[-1] if rows else None
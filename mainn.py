@@ -1,17 +1,30 @@
 import os
-import re
+import math
 import csv
 import time
 import cv2
 import pickle
 import argparse
+import asyncio
+import heapq
+import threading
+import aiohttp
+import requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from streetlevel import yandex
 from datetime import datetime
-from typing import Optional, List
-from PIL import Image
-import imagehash
+from typing import Optional, Iterable, List, Tuple, Dict
 import numpy as np
-from py360convert import e2p
+from rate_limit import AdaptiveRateLimiter, CircuitBreaker, RetryBudget, RequestScheduler, RetryLater, backoff_delay
+from pano_cache import PanoramaCache
+from raw_store import RawPanoramaStore, STORE_MODES, EVICTION_POLICIES, download_roi_band, effective_zoom
+from state_store import YearStateStore
+from log_writers import BufferedCsvWriter, last_csv_row, tail_csv_rows
+from image_pipeline import ImagePipeline, ImagePoolError, default_image_workers
+from dedup_index import HashIndex, DEFAULT_THRESHOLD, hash_to_int, load_year_hashes
+from roads import iter_segments, cell_key, cell_center
+from telemetry import Telemetry
 
 # ==============================================================================
 # КОНФИГУРАЦИЯ
@@ -19,7 +32,30 @@ from py360convert import e2p
 INPUT_CSV = "almaty_roads.csv"
 OUTPUT_DIR_BASE = "output"
 TEMP_DIR = "temp_panoramas"
-TIME_DELAY = 1.0
+TIME_DELAY = 1.0    # начальный интервал между запросами; дальше лимит подстраивается (AIMD)
+MIN_RPS = 0.2               # нижняя граница адаптивного лимита, запр./с
+RPS_INCREASE = 0.05         # прирост лимита за секунду без ошибок, доля от --rps
+MAX_ATTEMPTS = 4            # попыток одного запроса при временных ошибках
+BACKOFF_BASE_SECONDS = 1.0  # база экспоненциальной задержки между попытками
+BACKOFF_CAP_SECONDS = 30.0
+BREAKER_FAILURES = 5        # ошибок подряд, после которых запросы приостанавливаются
+BREAKER_RESET_SECONDS = 30.0
+POINT_RETRIES = 5           # сколько раз точка возвращается в очередь повторов, прежде чем отложиться до следующего запуска
+POINT_RETRY_BASE_SECONDS = 10.0
+POINT_RETRY_CAP_SECONDS = 300.0
+RAW_STORE_GB = 0.0          # лимит хранилища исходников панорам в TEMP_DIR, ГБ; 0 - без ограничения
+DOWNLOAD_LOCK_STRIPES = 64  # блокировки загрузок по pano_id: одну панораму не качают два воркера сразу
+STEP_M = 50.0   # шаг передискретизации дорог, м (0 - использовать вершины WKT как есть)
+CELL_M = 25.0   # размер ячейки сетки для пространственной дедупликации точек, м
+CACHE_TTL_DAYS = 90  # срок жизни записей кэша метаданных панорам (0 - бессрочно)
+LOG_FLUSH_ROWS = 200        # сброс буфера логов каждые N строк...
+LOG_FLUSH_SECONDS = 5.0     # ...или раз в N секунд
+CHECKPOINT_SECONDS = 60.0   # как часто логи сбрасываются на диск с fsync
+REPORT_SECONDS = 60.0       # как часто печатать скорость и ETA и выгружать метрики
+IMAGE_TIMEOUT_SECONDS = 300.0  # сколько ждать видов точки из пула, прежде чем счесть пул зависшим
+# NEW ROI: Возвращаем колонку View в лог
+METADATA_HEADER = ["ID", "ObjectID", "PanoID", "RoadName", "Latitude", "Longitude", "YearFound", "View", "FilePath", "PanoramaDate"]
+NO_PANORAMA_COLUMNS = ["RoadName", "Latitude", "Longitude", "ObjectID"]
 
 # ==============================================================================
 # ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ
@@ -37,10 +73,6 @@ def transliterate(string: str) -> str:
         'Ө': 'O', 'ө': 'o', 'Ұ': 'U', 'ұ': 'u', 'Ү': 'U', 'ү': 'u', 'Һ': 'H', 'һ': 'h', 'І': 'I', 'і': 'i'
     }
     return ''.join(cyrillic_to_latin.get(char, char) for char in string)
-def fix_encoding(s: str) -> str:
-    if not isinstance(s, str) or not s: return s
-    try: return s.encode("cp1251").decode("utf-8")
-    except Exception: return s
 def get_date_from_pano_id(pano_id: str) -> Optional[datetime]:
     parts = pano_id.split("_");
     if not parts: return None
@@ -48,6 +80,67 @@ def get_date_from_pano_id(pano_id: str) -> Optional[datetime]:
         return datetime.utcfromtimestamp(int(parts[-1]))
     except (ValueError, IndexError, TypeError):
         return None
+def haversine_m(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi, d_lambda = phi2 - phi1, math.radians(lon2 - lon1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * 6371000.0 * math.asin(math.sqrt(a))
+def densify_path(path: List[Tuple[float, float]], step_m: float) -> List[Tuple[float, float]]:
+    """
+    Передискретизирует полилинию с равным шагом step_m вдоль ее длины.
+    Первая и последняя вершины сохраняются, промежуточные вершины WKT заменяются точками с шагом.
+    """
+    if step_m <= 0 or len(path) < 2: return list(path)
+    resampled = [path[0]]
+    since_last = 0.0  # расстояние от последней выданной точки до начала текущего отрезка
+    for (lat1, lon1), (lat2, lon2) in zip(path, path[1:]):
+        seg_len = haversine_m(lat1, lon1, lat2, lon2)
+        if seg_len == 0: continue
+        pos = step_m - since_last
+        while pos < seg_len:
+            t = pos / seg_len
+            resampled.append((lat1 + (lat2 - lat1) * t, lon1 + (lon2 - lon1) * t))
+            pos += step_m
+        since_last = seg_len - (pos - step_m)
+    if resampled[-1] != path[-1]: resampled.append(path[-1])
+    return resampled
+def migrate_processed_coords(processed: set, old_cell_m: Optional[float], cell_m: float) -> set:
+    """
+    Приводит processed_coords из старого state.pkl к ключам текущей сетки:
+    точные координаты (float, float) переводятся в свою ячейку, ключи другой сетки - через центр ячейки.
+    """
+    migrated = set()
+    for key in processed:
+        if isinstance(key[0], float): migrated.add(cell_key(key[0], key[1], cell_m))
+        elif old_cell_m != cell_m: migrated.add(cell_key(*cell_center(key, old_cell_m), cell_m))
+        else: migrated.add(key)
+    return migrated
+def prepare_points(segments: Iterable[dict], step_m: float, cell_m: float) -> Tuple[List[dict], dict]:
+    """
+    Стадия предобработки между чтением CSV и основным циклом: передискретизирует каждую дорогу
+    с шагом step_m и оставляет по одной точке на ячейку сетки по всем дорогам сразу
+    (ячейка достается первой дороге, в которой встретилась). Сегменты читаются потоком, у дорог
+    остаются только name, object_id и points - список (lat, lon, cell); исходная геометрия не хранится.
+    Возвращает (дороги, статистика).
+    """
+    roads = []
+    seen_cells = set()
+    segment_count = raw_vertices = resampled_points = 0
+    for segment in segments:
+        if not segment['name'] or not segment['object_id']: continue
+        segment_count += 1
+        raw_vertices += len(segment['path'])
+        resampled = densify_path(segment['path'], step_m)
+        resampled_points += len(resampled)
+        points = []
+        for lat, lon in resampled:
+            key = cell_key(lat, lon, cell_m)
+            if key in seen_cells: continue
+            seen_cells.add(key)
+            points.append((lat, lon, key))
+        if points: roads.append({'name': segment['name'], 'object_id': segment['object_id'], 'points': points})
+    return roads, {'segments': segment_count, 'raw_vertices': raw_vertices, 'resampled_points': resampled_points,
+                   'unique_cells': len(seen_cells)}
 def autocrop_image(img: np.ndarray) -> np.ndarray:
     gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
     mask = cv2.inRange(gray, 10, 245)
@@ -60,36 +153,331 @@ def autocrop_image(img: np.ndarray) -> np.ndarray:
         return img
     return img[y:y+h, x:x+w]
     
-#Функция для нарезки панорамы на виды "вперед" и "назад"
-def crop_panorama_to_roi(img: np.ndarray, year: str) -> List[dict]:
+# ==============================================================================
+# СОСТОЯНИЕ ПО ГОДАМ
+# ==============================================================================
+MIN_YEAR, MAX_YEAR = 2011, 2029
+def parse_years(spec: str) -> List[str]:
+    """Разбирает список лет вида "2015-2024" или "2015,2017,2020-2022"."""
+    years = set()
+    for part in spec.split(","):
+        part = part.strip()
+        if not part: continue
+        first, _, last = part.partition("-")
+        if not first.strip().isdigit() or (last and not last.strip().isdigit()):
+            raise ValueError(f"Некорректный диапазон лет: {part}")
+        first_year, last_year = int(first), int(last or first)
+        if first_year > last_year or first_year < MIN_YEAR or last_year > MAX_YEAR:
+            raise ValueError(f"Некорректный диапазон лет: {part}")
+        years.update(range(first_year, last_year + 1))
+    if not years: raise ValueError(f"Пустой список лет: {spec!r}")
+    return [str(year) for year in sorted(years)]
+
+class YearContext:
     """
-    Принимает панораму, нарезает ее на перспективные виды (вперед/назад)
-    и возвращает список словарей, каждый из которых содержит вид и его название.
+    Все, что относится к одному году: папка вывода, metadata_{YEAR}.csv,
+    no_panorama_addresses_{YEAR}.csv, журнал состояния state.sqlite, хэши изображений и счетчик ID.
+    В многолетнем режиме у каждого года свой контекст, а поиск по точке общий.
     """
-    # Здесь можно хранить профили обрезки для разных лет, как мы делали раньше
-    profiles = {
-        "default": {"v_deg": -20, "top_frac": 0.5, "end_frac": 1.0, "sub_crop": 0.3},
-        "2017": {"v_deg": -7, "top_frac": 0.4, "end_frac": 0.9, "sub_crop": 0.1}
-    }
-    profile = profiles.get(year, profiles["default"])
-    
-    output_views = []
-    
-    for yaw, view_label in [(180, "front"), (0, "back")]:
-        view = e2p(img, fov_deg=70, u_deg=yaw, v_deg=profile["v_deg"], out_hw=(1536, 1536))
-        h, _, _ = view.shape
-        
-        top_px = int(h * profile["top_frac"])
-        end_px = int(h * profile["end_frac"])
-        primary_crop = view[top_px:end_px, :, :]
-        
-        h_sub, _, _ = primary_crop.shape
-        sub_crop_px = int(h_sub * profile["sub_crop"])
-        final_crop = primary_crop[sub_crop_px:, :, :]
-        
-        output_views.append({"label": view_label, "image": final_crop})
-        
-    return output_views
+    def __init__(self, year: str, cell_m: float, dedup_index: HashIndex, telemetry: Telemetry, parquet: bool = False):
+        self.year = year
+        self.cell_m = cell_m
+        self.telemetry = telemetry
+        self.output_dir = os.path.join(OUTPUT_DIR_BASE, year)
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.log_file = os.path.join(self.output_dir, f"metadata_{year}.csv")
+        self.bad_addresses_file = os.path.join(self.output_dir, f"no_panorama_addresses_{year}.csv")
+        self.legacy_state_path = os.path.join(self.output_dir, "state.pkl")
+        self.store = YearStateStore(os.path.join(self.output_dir, "state.sqlite"))
+        if self.store.is_new and os.path.exists(self.legacy_state_path):
+            self._import_legacy_state()
+        elif self.store.is_new:
+            print(f"ℹ️ Журнал состояния для {year} года не найден, будет создан новый.")
+        else:
+            print(f"✅ Загружен журнал состояния для {year} года.")
+        # processed_coords хранит ключи ячеек сетки, а не точные координаты
+        self.processed_coords = self.store.processed_cells()
+        stored_cell_m = self.store.get_meta('cell_m')
+        if stored_cell_m is not None and float(stored_cell_m) != cell_m:
+            self.processed_coords = migrate_processed_coords(self.processed_coords, float(stored_cell_m), cell_m)
+            self.store.replace_processed_cells(self.processed_coords)
+        self.store.set_meta('cell_m', cell_m)
+        # Индекс почти-дубликатов может быть общим для нескольких лет (--dedup-scope all)
+        self.dedup_index = dedup_index
+        year_hashes, year_view_ids = self.store.image_hashes()
+        self.dedup_index.add_many(year_hashes, year_view_ids)
+        self.stats = {'total_duration_seconds': float(self.store.get_meta('total_duration_seconds', 0.0))}
+        print(f"-> Обработанных координат: {len(self.processed_coords)}")
+        print(f"-> Уникальных изображений: {len(year_hashes)}")
+        self.logged_pano_ids = self.store.logged_pano_ids()
+        self.global_id = self.store.last_view_id()
+        print(f"✅ Найдено {len(self.logged_pano_ids)} уже обработанных панорам в журнале. Начальный ID: {self.global_id}")
+        self.log_writer = BufferedCsvWriter(self.log_file, header=METADATA_HEADER, flush_rows=LOG_FLUSH_ROWS, flush_seconds=LOG_FLUSH_SECONDS,
+                                            parquet_dir=os.path.join(self.output_dir, f"metadata_{year}_parquet") if parquet else None)
+        self.bad_addresses_writer = BufferedCsvWriter(self.bad_addresses_file, columns=NO_PANORAMA_COLUMNS, flush_rows=LOG_FLUSH_ROWS, flush_seconds=LOG_FLUSH_SECONDS,
+                                                      parquet_dir=os.path.join(self.output_dir, f"no_panorama_addresses_{year}_parquet") if parquet else None)
+        self._recover_log_rows()
+        self._recover_no_panorama_rows()
+        self._last_checkpoint = time.monotonic()
+
+    def _recover_log_rows(self) -> None:
+        """Дописывает в metadata-лог строки, которые были в журнале, но не успели сброситься из буфера."""
+        last_row = last_csv_row(self.log_file)
+        last_logged_id = int(last_row[0]) if last_row and last_row[0].isdigit() else 0
+        missing_rows = self.store.log_rows_after(last_logged_id)
+        if not missing_rows: return
+        for row in missing_rows: self.log_writer.write_row(row)
+        self.log_writer.checkpoint()
+        print(f"🩹 Восстановлено {len(missing_rows)} строк лога {os.path.basename(self.log_file)} из журнала.")
+
+    def _recover_no_panorama_rows(self) -> None:
+        """
+        Дописывает строки no_panorama, которые были в журнале, но не успели сброситься из буфера.
+        Уже сброшенные строки журнала лежат в конце CSV и повторно не пишутся.
+        """
+        pending = self.store.pending_no_panorama_rows()
+        if not pending: return
+        as_csv = [['' if value is None else str(value) for value in row] for row in pending]
+        tail = tail_csv_rows(self.bad_addresses_file, len(pending), tail_bytes=max(65536, 1024 * len(pending)))
+        written = next((k for k in range(min(len(tail), len(pending)), 0, -1) if tail[-k:] == as_csv[:k]), 0)
+        for row in pending[written:]: self.bad_addresses_writer.write_row(row)
+        self.bad_addresses_writer.checkpoint()
+        self.store.clear_no_panorama_rows()
+        if written < len(pending):
+            print(f"🩹 Восстановлено {len(pending) - written} строк лога {os.path.basename(self.bad_addresses_file)} из журнала.")
+
+    def _import_legacy_state(self) -> None:
+        """Одноразовый перенос старого state.pkl и уже записанного лога в журнал состояния."""
+        try:
+            with open(self.legacy_state_path, "rb") as f: state = pickle.load(f)
+        except EOFError:
+            state = {}
+        cells = migrate_processed_coords(state.get('processed_coords', set()), state.get('cell_m'), self.cell_m)
+        views = []
+        try:
+            with open(self.log_file, 'r', newline='', encoding='utf-8') as f:
+                reader = csv.DictReader(f)
+                for row in reader:
+                    if row.get('PanoID') and row.get('ID') and row['ID'].isdigit():
+                        views.append((int(row['ID']), row['PanoID'], row.get('View')))
+        except FileNotFoundError:
+            pass
+        self.store.import_legacy(cells, views, (hash_to_int(str(h)) for h in state.get('image_hashes', set())))
+        self.store.set_meta('total_duration_seconds', state.get('stats', {}).get('total_duration_seconds', 0.0))
+        print(f"✅ Файл состояния state.pkl для {self.year} года перенесен в журнал state.sqlite.")
+
+    def save_panorama_views(self, pano, rendered_views: Optional[List[dict]], object_id: str, road_name: str, sanitized_name: str) -> None:
+        """
+        Сохраняет виды панорамы, уже нарезанные и закодированные в пуле процессов (см. image_pipeline),
+        отбрасывает дубликаты и пишет новые виды в лог года. Вызывается строго в порядке обхода,
+        поэтому нумерация ID и имена файлов не зависят от числа воркеров.
+        """
+        pano_date = getattr(pano, 'date', None) or get_date_from_pano_id(pano.id)
+        if rendered_views is None:
+            print(f"   × Ошибка чтения исходника панорамы {pano.id} из {TEMP_DIR}")
+            self.telemetry.count("errors", type="image_read")
+            return
+
+        for view_data in rendered_views:
+            view_label = view_data["label"]
+            h_hash = hash_to_int(view_data["hash"])
+
+            with self.telemetry.timer("dedup_lookup"):
+                distance = self.dedup_index.nearest_distance(h_hash)
+            if distance is not None:
+                print(f"   ℹ️ Дубликат вида '{view_label}' (расстояние pHash: {distance}). Пропускаем.")
+                self.telemetry.count("duplicates", year=self.year)
+                continue
+            if view_data["jpeg"] is None: continue
+
+            current_id = self.global_id + 1
+            filename = f"{self.year}_{current_id:05d}_{sanitized_name}_{view_label}.jpg"
+            filepath = os.path.join(self.output_dir, filename)
+
+            with self.telemetry.timer("write_view"):
+                with open(filepath, "wb") as f_img: f_img.write(view_data["jpeg"])
+                self.global_id = current_id
+                self.dedup_index.add(h_hash, current_id)
+                self.logged_pano_ids.add(pano.id) # Добавляем основной ID, чтобы не обрабатывать панораму заново
+                log_row = [self.global_id, object_id, pano.id, road_name, pano.lat, pano.lon, self.year, view_label, filepath, pano_date.strftime("%Y-%m-%d %H:%M:%S")]
+                self.store.add_view(self.global_id, pano.id, view_label, h_hash, log_row)
+                self.log_writer.write_row(log_row)
+            self.telemetry.count("views_saved", year=self.year)
+            self.telemetry.count("view_bytes", len(view_data["jpeg"]), year=self.year)
+            print(f"   💾 Сохранен вид '{view_label}' ({self.year}): {filepath}")
+
+    def log_no_panorama(self, cell: Tuple[int, int], road_name: str, lat: float, lon: float, object_id: str) -> None:
+        self.mark_processed(cell, no_panorama_row=[road_name, lat, lon, object_id])
+        self.telemetry.count("no_panorama", year=self.year)
+
+    def mark_processed(self, cell: Tuple[int, int], no_panorama_row: Optional[list] = None) -> None:
+        with self.telemetry.timer("journal"):
+            self.processed_coords.add(cell)
+            # Строка no_panorama попадает в журнал в одной транзакции с ячейкой и только потом в буфер CSV
+            self.store.add_point(cell, no_panorama_row)
+            if no_panorama_row: self.bad_addresses_writer.write_row(no_panorama_row)
+            self.log_writer.maybe_flush()
+            self.bad_addresses_writer.maybe_flush()
+            if time.monotonic() - self._last_checkpoint >= CHECKPOINT_SECONDS:
+                self.checkpoint()
+
+    def checkpoint(self) -> None:
+        self.log_writer.checkpoint()
+        self.bad_addresses_writer.checkpoint()
+        self.store.clear_no_panorama_rows()
+        self._last_checkpoint = time.monotonic()
+
+    def save_state(self, session_duration_seconds: float) -> None:
+        self.log_writer.close()
+        self.bad_addresses_writer.close()
+        self.store.clear_no_panorama_rows()
+        self.stats['total_duration_seconds'] += session_duration_seconds
+        self.store.set_meta('total_duration_seconds', self.stats['total_duration_seconds'])
+        self.store.close()
+
+# ==============================================================================
+# СЕТЕВАЯ ЧАСТЬ: ПОИСК И ЗАГРУЗКА ПАНОРАМ
+# ==============================================================================
+def describe_api_error(e: Exception) -> str:
+    if "Expecting value" in str(e): return f"   ℹ️ API Яндекса вернул некорректный ответ. Пропускаем точку."
+    return f"   ⚠️ Неожиданная ошибка: {e}"
+
+def is_transient_api_error(e: Exception) -> bool:
+    """
+    Ошибки, после которых запрос стоит повторить: обрывы соединения и таймауты, 429 и 5xx,
+    а также пустой или HTML-ответ вместо JSON ("Expecting value"), которым API отвечает при перегрузке.
+    """
+    if isinstance(e, requests.HTTPError):
+        status = e.response.status_code if e.response is not None else None
+        return status is None or status == 429 or status >= 500
+    if isinstance(e, (requests.ConnectionError, requests.Timeout)): return True
+    # Тайлы панорам streetlevel качает через aiohttp
+    if isinstance(e, aiohttp.ClientResponseError): return e.status == 429 or e.status >= 500
+    if isinstance(e, (aiohttp.ClientError, asyncio.TimeoutError)): return True
+    return isinstance(e, ValueError) and "Expecting value" in str(e)
+
+class PanoramaFetcher:
+    """
+    Сетевая стадия обработки точки: один поиск по точке, выбор панорам всех запрошенных лет
+    и загрузка их исходников в RawPanoramaStore. Безопасна для вызова из нескольких потоков: все
+    запросы к API проходят через общий RequestScheduler (адаптивный лимит, повторы, размыкатель),
+    а одну и ту же панораму два воркера одновременно не скачивают. Кому из точек достанется
+    общая панорама, решает основной поток при записи, строго в порядке обхода: fetch лишь
+    отсеивает панорамы, которые уже в логе, поэтому результат не зависит от числа воркеров.
+    Ответы find_panorama и find_panorama_by_id берутся из PanoramaCache, если они там есть.
+    Если временная ошибка не прошла и после повторов, fetch поднимает RetryLater: такая точка
+    не считается точкой без панорамы.
+    """
+    def __init__(self, year_contexts: Dict[str, YearContext], scheduler: RequestScheduler, cache: PanoramaCache,
+                 raw_store: RawPanoramaStore, cell_m: float, telemetry: Telemetry):
+        self.year_contexts = year_contexts
+        self.scheduler = scheduler
+        self.cache = cache
+        self.raw_store = raw_store
+        self.cell_m = cell_m
+        self.telemetry = telemetry
+        self._download_locks = [threading.Lock() for _ in range(DOWNLOAD_LOCK_STRIPES)]
+
+    def release(self, pano_id: str) -> None:
+        """Отпускает исходник, захваченный fetch (по одному release на каждую возвращенную панораму)."""
+        self.raw_store.release(pano_id)
+
+    def _find_panorama(self, lat: float, lon: float, cell: Tuple[int, int]):
+        cached, pano = self.cache.get_lookup(cell, self.cell_m)
+        self.telemetry.count("lookups", source="cache" if cached else "api")
+        if cached: return pano
+        pano = self.scheduler.call("find_panorama", yandex.find_panorama, lat, lon)
+        self.cache.put_lookup(cell, self.cell_m, pano)
+        return pano
+
+    def _find_panorama_by_id(self, pano_id: str):
+        cached, pano = self.cache.get_pano(pano_id)
+        self.telemetry.count("lookups_by_id", source="cache" if cached else "api")
+        if cached: return pano
+        pano = self.scheduler.call("find_panorama_by_id", yandex.find_panorama_by_id, pano_id)
+        self.cache.put_pano(pano_id, pano)
+        return pano
+
+    def _download(self, pano, year: str, notes: List[str]) -> None:
+        # Общую панораму соседних точек качает один воркер, остальные берут ее из хранилища
+        with self._download_locks[hash(pano.id) % DOWNLOAD_LOCK_STRIPES]: self._download_locked(pano, year, notes)
+        # Размер меняется и при вытеснении, которое мог выполнить другой поток или процесс
+        self.telemetry.gauge("raw_store_bytes", self.raw_store.total_bytes)
+
+    def _download_locked(self, pano, year: str, notes: List[str]) -> None:
+        store = self.raw_store
+        if store.acquire(pano.id, year) is not None: return
+        tmp_path = store.tmp_path(pano.id)
+        # Обе загрузки получают уже приведенный зум: в индекс пишется то, что реально скачано
+        zoom = effective_zoom(pano, store.zoom)
+        if store.mode == "roi":
+            notes.append(f"   -> Скачиваем тайлы ROI панорамы {pano.id}...")
+            band, download_bytes = self.scheduler.call("download_panorama", download_roi_band, pano, year, zoom, tmp_path)
+        else:
+            notes.append(f"   -> Скачиваем панораму {pano.id}...")
+            self.scheduler.call("download_panorama", yandex.download_panorama, pano, tmp_path, zoom=zoom)
+            download_bytes = os.path.getsize(tmp_path)
+            band = None  # в режиме band полосу вырежет пул изображений (RawEntry.band_path)
+        self.telemetry.count("downloads")
+        self.telemetry.count("download_bytes", download_bytes)
+        store.put(pano.id, tmp_path, year, band, zoom)
+
+    def fetch(self, lat: float, lon: float, cell: Tuple[int, int], years: List[str]) -> Tuple[Dict[str, object], List[str]]:
+        """
+        Возвращает ({год: панорама}, сообщения) для запрошенных лет. Панорама попадает в результат
+        только если ее исходник уже лежит в TEMP_DIR и захвачен в хранилище до release; сообщения
+        печатаются основным потоком, чтобы вывод точек не перемешивался.
+        """
+        notes = []
+        found = {}
+        try:
+            latest_pano = self._find_panorama(lat, lon, cell)
+            if not latest_pano: raise StopIteration("Панорамы не найдены для этой точки.")
+            all_panos_at_location = [latest_pano] + (getattr(latest_pano, 'historical', None) or [])
+
+            for year in years:
+                for pano_candidate in all_panos_at_location:
+                    pano_date = getattr(pano_candidate, 'date', None) or get_date_from_pano_id(pano_candidate.id)
+                    if pano_date and pano_date.year == int(year):
+                        # Только подсказка, чтобы не качать лишнего: окончательно решает основной поток
+                        if pano_candidate.id in self.year_contexts[year].logged_pano_ids:
+                            notes.append(f"   ℹ️ Найдена панорама {year} года ({pano_candidate.id}), но она уже в логе.")
+                        else:
+                            notes.append(f"   🎯 Найдена панорама за {year} год! ID: {pano_candidate.id}")
+                            found[year] = pano_candidate
+                        break
+                else:
+                    notes.append(f"   ℹ️ Панорамы за {year} год не найдены для этой точки.")
+        except StopIteration as e: notes.append(f"   {e}")
+        except RetryLater: raise
+        except Exception as e:
+            notes.append(describe_api_error(e))
+            self.telemetry.count("errors", type=type(e).__name__)
+
+        ready = {}
+        try:
+            for year, pano in found.items():
+                if getattr(pano, 'image_sizes', None) is None:
+                    notes.append(f"   -> Получаем полную информацию для исторической панорамы ({year})...")
+                    try: pano = self._find_panorama_by_id(pano.id) or pano
+                    except RetryLater: raise
+                    except Exception as e:
+                        notes.append(describe_api_error(e))
+                        self.telemetry.count("errors", type=type(e).__name__)
+                if not pano.image_sizes: continue
+                try: self._download(pano, year, notes)
+                except RetryLater: raise
+                except Exception as e:
+                    # Например, 404 на тайлы: повтор не поможет, год точки остается без панорамы
+                    notes.append(describe_api_error(e))
+                    self.telemetry.count("errors", type=type(e).__name__)
+                    continue
+                ready[year] = pano
+        except RetryLater:
+            # Точка вернется в очередь целиком: захваченные исходники отпускаются, скачанное остается в хранилище
+            for pano in ready.values(): self.release(pano.id)
+            raise
+        return ready, notes
 
 # ==============================================================================
 # ГЛАВНЫЙ СКРИПТ
@@ -97,195 +485,250 @@ def crop_panorama_to_roi(img: np.ndarray, year: str) -> List[dict]:
 def main():
     parser = argparse.ArgumentParser(description="Сборщик панорам Яндекс по годам.")
     parser.add_argument("year", type=int, nargs='?', default=None, help="Год для обработки (например, 2023). Если не указан, будет запрошен.")
+    parser.add_argument("--years", type=str, default=None, help="Несколько лет за один проход, например 2015-2024 или 2015,2017,2020-2022.")
+    parser.add_argument("--all-years", action="store_true", help=f"Обработать все годы с {MIN_YEAR} по текущий за один проход.")
+    parser.add_argument("--workers", type=int, default=1, help="Число параллельных воркеров для поиска и загрузки панорам (по умолчанию 1).")
+    parser.add_argument("--image-workers", type=int, default=default_image_workers(), help="Число процессов для нарезки, хэширования и кодирования изображений (по умолчанию - все ядра).")
+    parser.add_argument("--rps", type=float, default=1.0 / TIME_DELAY, help=f"Начальный лимит запросов к API в секунду на все воркеры (по умолчанию {1.0 / TIME_DELAY:g}).")
+    parser.add_argument("--max-rps", type=float, default=None, help="Потолок адаптивного лимита, запр./с; равный --rps отключает разгон (по умолчанию 4 x --rps).")
+    parser.add_argument("--min-rps", type=float, default=MIN_RPS, help=f"Нижняя граница адаптивного лимита, запр./с (по умолчанию {MIN_RPS:g}).")
+    parser.add_argument("--max-attempts", type=int, default=MAX_ATTEMPTS, help=f"Попыток одного запроса при временных ошибках API (по умолчанию {MAX_ATTEMPTS}).")
+    parser.add_argument("--point-retries", type=int, default=POINT_RETRIES, help=f"Сколько раз точка с временной ошибкой возвращается в очередь, прежде чем отложиться до следующего запуска (по умолчанию {POINT_RETRIES}).")
+    parser.add_argument("--step-m", type=float, default=STEP_M, help=f"Шаг передискретизации дорог в метрах, 0 - вершины WKT как есть (по умолчанию {STEP_M:g}).")
+    parser.add_argument("--cache-ttl-days", type=float, default=CACHE_TTL_DAYS, help=f"Срок жизни кэша метаданных панорам в днях, 0 - бессрочно (по умолчанию {CACHE_TTL_DAYS}).")
+    parser.add_argument("--parquet", action="store_true", help="Дублировать логи в Parquet рядом с CSV (нужен pyarrow).")
+    parser.add_argument("--dedup-threshold", type=int, default=DEFAULT_THRESHOLD, help=f"Порог расстояния Хэмминга между pHash, при котором вид считается дубликатом, 0 - только точные совпадения (по умолчанию {DEFAULT_THRESHOLD}).")
+    parser.add_argument("--dedup-scope", choices=["year", "all"], default="year", help="Искать дубликаты внутри года или по всем годам в output/ (по умолчанию year).")
+    parser.add_argument("--cell-m", type=float, default=CELL_M, help=f"Размер ячейки сетки для дедупликации точек в метрах (по умолчанию {CELL_M:g}).")
+    parser.add_argument("--no-road-cache", action="store_true", help="Разобрать CSV с дорогами заново, не используя и не обновляя бинарный кэш геометрии.")
+    parser.add_argument("--metrics-file", default=None, help="Файл метрик: *.prom - Prometheus textfile, иначе JSON lines (по умолчанию не пишется).")
+    parser.add_argument("--raw-store", choices=STORE_MODES, default="full",
+                        help="Что хранить в temp_panoramas: full - полные панорамы; band - только полосу тайлов, нужную для видов; "
+                             "roi - скачивать только эти тайлы (по умолчанию full).")
+    parser.add_argument("--raw-zoom", type=int, default=0, help="Уровень зума исходников: 0 - максимальное разрешение, 4 - минимальное (по умолчанию 0).")
+    parser.add_argument("--raw-store-gb", type=float, default=RAW_STORE_GB, help="Лимит размера temp_panoramas в ГБ, сверх него старые исходники удаляются; 0 - без ограничения (по умолчанию 0).")
+    parser.add_argument("--raw-evict", choices=EVICTION_POLICIES, default="lru", help="Какие исходники удалять первыми: lru - давно не использованные, lfu - редко использованные (по умолчанию lru).")
+    parser.add_argument("--report-seconds", type=float, default=REPORT_SECONDS, help=f"Как часто печатать скорость и ETA и выгружать метрики, с (по умолчанию {REPORT_SECONDS:g}).")
     args = parser.parse_args()
-    if args.year:
-        YEAR = str(args.year)
+    if args.max_rps is None: args.max_rps = args.rps * 4
+    if args.workers < 1 or args.image_workers < 1 or args.rps <= 0 or args.step_m < 0 or args.cell_m <= 0 or args.cache_ttl_days < 0 or not 0 <= args.dedup_threshold < 64 or args.report_seconds <= 0 \
+            or not 0 < args.min_rps <= args.rps <= args.max_rps or args.max_attempts < 1 or args.point_retries < 0 \
+            or not 0 <= args.raw_zoom <= 4 or args.raw_store_gb < 0:
+        print(f"❌ Некорректные параметры: --workers {args.workers}, --image-workers {args.image_workers}, --rps {args.rps}, --step-m {args.step_m}, --cell-m {args.cell_m}, "
+              f"--cache-ttl-days {args.cache_ttl_days}, --dedup-threshold {args.dedup_threshold}, --report-seconds {args.report_seconds}, "
+              f"--min-rps {args.min_rps}, --max-rps {args.max_rps}, --max-attempts {args.max_attempts}, --point-retries {args.point_retries}, "
+              f"--raw-zoom {args.raw_zoom}, --raw-store-gb {args.raw_store_gb}. Выход."); exit()
+    if args.all_years:
+        YEARS = [str(year) for year in range(MIN_YEAR, min(datetime.now().year, MAX_YEAR) + 1)]
+    elif args.years:
+        try: YEARS = parse_years(args.years)
+        except ValueError as e: print(f"❌ {e}. Выход."); exit()
     else:
-        YEAR = input("➡️ Введите год для обработки (например, 2023): ")
-    if not YEAR.isdigit() or not (2010 < int(YEAR) < 2030):
-        print(f"❌ Некорректный год: {YEAR}. Выход."); exit()
-    print(f"🚀 Запускаем обработку для {YEAR} года.")
-    output_dir = os.path.join(OUTPUT_DIR_BASE, YEAR)
-    os.makedirs(output_dir, exist_ok=True)
+        if args.year:
+            YEAR = str(args.year)
+        else:
+            YEAR = input("➡️ Введите год для обработки (например, 2023): ")
+        if not YEAR.isdigit() or not (2010 < int(YEAR) < 2030):
+            print(f"❌ Некорректный год: {YEAR}. Выход."); exit()
+        YEARS = [YEAR]
+    years_label = f"{YEARS[0]} года" if len(YEARS) == 1 else f"лет {', '.join(YEARS)}"
+    print(f"🚀 Запускаем обработку для {years_label} (воркеров: {args.workers}, процессов для изображений: {args.image_workers}, "
+          f"лимит: {args.rps:g} запр./с, адаптивно от {args.min_rps:g} до {args.max_rps:g}).")
     os.makedirs(TEMP_DIR, exist_ok=True)
-    log_file = os.path.join(output_dir, f"metadata_{YEAR}.csv")
-    bad_addresses_file = os.path.join(output_dir, f"no_panorama_addresses_{YEAR}.csv")
-    state_path = os.path.join(output_dir, "state.pkl")
-    cache_path = os.path.join(TEMP_DIR, "panorama_cache.pkl")
-    if not os.path.exists(log_file):
-        with open(log_file, "w", newline="", encoding="utf-8") as f:
-            writer = csv.writer(f)
-            # NEW ROI: Возвращаем колонку View в лог
-            writer.writerow(["ID", "ObjectID", "PanoID", "RoadName", "Latitude", "Longitude", "YearFound", "View", "FilePath", "PanoramaDate"])
-    try:
-        with open(cache_path, "rb") as f: panorama_cache = pickle.load(f)
-    except (FileNotFoundError, EOFError): panorama_cache = {}
-    try:
-        with open(state_path, "rb") as f: state = pickle.load(f)
-        print(f"✅ Загружен файл состояния для {YEAR} года.")
-    except (FileNotFoundError, EOFError):
-        state = { 'processed_coords': set(), 'image_hashes': set(), 'stats': {'total_duration_seconds': 0.0} }
-        print(f"ℹ️ Файл состояния для {YEAR} года не найден, будет создан новый.")
-    processed_coords = state['processed_coords']
-    image_hashes = state['image_hashes']
-    stats = state['stats']
-    print(f"-> Обработанных координат: {len(processed_coords)}")
-    print(f"-> Уникальных изображений: {len(image_hashes)}")
-    logged_pano_ids = set()
-    global_id = 0
-    try:
-        with open(log_file, 'r', newline='', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                if row.get('PanoID'): logged_pano_ids.add(row['PanoID'])
-                if row.get('ID') and row['ID'].isdigit():
-                    current_id = int(row['ID'])
-                    if current_id > global_id: global_id = current_id
-        print(f"✅ Найдено {len(logged_pano_ids)} уже обработанных панорам в логе. Начальный ID: {global_id}")
-    except FileNotFoundError:
-        print("ℹ️ Лог-файл не найден, начинаем с нуля.")
-    all_roads_data = []
-    with open(INPUT_CSV, mode="r", encoding="utf-8") as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            raw_name, object_id = (row.get("name") or row.get("name_ru") or "").strip(), row.get("objectid")
-            if not raw_name or not object_id: continue
-            road_name, geom = fix_encoding(raw_name), (row.get("geometry_wkt") or "").strip()
-            coords_pairs = re.findall(r"([-\d\.]+)\s+([-\d\.]+)", geom)
-            if not coords_pairs: continue
-            path = [(float(lat), float(lon)) for lon, lat in coords_pairs]
-            all_roads_data.append({ "name": road_name, "object_id": object_id, "path": path })
-    if not all_roads_data:
+    cache_path = os.path.join(TEMP_DIR, "panorama_cache.sqlite")
+    panorama_cache = PanoramaCache(cache_path, ttl_seconds=args.cache_ttl_days * 86400)
+    raw_store = RawPanoramaStore(TEMP_DIR, args.raw_store, args.raw_zoom, int(args.raw_store_gb * 1e9), args.raw_evict)
+    raw_limit = f"лимит {args.raw_store_gb:g} ГБ, вытеснение {args.raw_evict}" if args.raw_store_gb else "без лимита"
+    print(f"🗂️  Исходники панорам: режим {args.raw_store}, зум {args.raw_zoom}, {raw_store.total_bytes / 1e9:.2f} ГБ ({raw_limit}).")
+    telemetry = Telemetry(args.metrics_file, report_seconds=args.report_seconds)
+    telemetry.gauge("raw_store_bytes", raw_store.total_bytes)
+    if args.dedup_scope == "all":
+        # Один индекс на все годы: виды, уже собранные за другие годы, тоже считаются дубликатами
+        shared_index = HashIndex(args.dedup_threshold)
+        for other_year in sorted(os.listdir(OUTPUT_DIR_BASE)) if os.path.isdir(OUTPUT_DIR_BASE) else []:
+            other_state = os.path.join(OUTPUT_DIR_BASE, other_year, "state.sqlite")
+            if other_year not in YEARS and os.path.exists(other_state):
+                shared_index.add_many(*load_year_hashes(other_state))
+        print(f"🔁 Дедупликация по всем годам: загружено {len(shared_index)} хэшей других лет.")
+        year_contexts = {year: YearContext(year, args.cell_m, shared_index, telemetry, args.parquet) for year in YEARS}
+    else:
+        year_contexts = {year: YearContext(year, args.cell_m, HashIndex(args.dedup_threshold), telemetry, args.parquet) for year in YEARS}
+    all_roads_data, points_stats = prepare_points(iter_segments(INPUT_CSV, use_cache=not args.no_road_cache), args.step_m, args.cell_m)
+    if not points_stats['segments']:
         print("⚠️ После чтения almaty_roads.csv не найдено ни одного валидного адреса."); exit(1)
-    print(f"Найдено {len(all_roads_data)} дорожных сегментов для обработки.")
+    print(f"Найдено {points_stats['segments']} дорожных сегментов для обработки.")
+    print(f"📐 Вершин в WKT: {points_stats['raw_vertices']}, после передискретизации (шаг {args.step_m:g} м): {points_stats['resampled_points']}, "
+          f"уникальных ячеек ({args.cell_m:g} м): {points_stats['unique_cells']}.")
+    print(f"   -> Запросов к API сэкономлено дедупликацией по ячейкам: {points_stats['resampled_points'] - points_stats['unique_cells']} "
+          f"(итого против обхода всех вершин: {points_stats['raw_vertices'] - points_stats['unique_cells']:+d}).")
     print(">>> СТАРТ основного цикла обработки улиц")
     start_time = time.time()
     streets_processed_this_session, coords_processed_this_session = 0, 0
-    total_coords_in_file = sum(len(road['path']) for road in all_roads_data)
+    total_coords_in_file = points_stats['unique_cells']
+    points_pending = sum(1 for road in all_roads_data for _, _, key in road['points']
+                         if any(key not in year_contexts[year].processed_coords for year in YEARS))
+
+    def iter_point_tasks():
+        # Ячейки уже уникальны по всем дорогам (см. prepare_points), остается пропустить точки,
+        # обработанные для всех запрошенных лет; поиск по точке делается один раз на все годы
+        for road_index, road in enumerate(all_roads_data):
+            for lat, lon, key in road['points']:
+                pending_years = [year for year in YEARS if key not in year_contexts[year].processed_coords]
+                if not pending_years: continue
+                yield road_index, road, lat, lon, key, pending_years
+
+    # Конвейер: сеть обрабатывается пулом потоков, скачанные панорамы сразу уходят в пул процессов
+    # (нарезка, хэш, JPEG), а сохранение и запись состояния идут в основном потоке строго в порядке
+    # обхода. Точка попадает в processed_coords только после того, как ее результат записан,
+    # поэтому прерванные "в полете" точки при возобновлении повторятся. Окно max_in_flight
+    # ограничивает обе очереди и дает backpressure, если одна из стадий не успевает.
+    # Точка, на которой API не ответил и после повторов (RetryLater) или пул изображений сломался
+    # либо не уложился в IMAGE_TIMEOUT_SECONDS (ImagePoolError), уходит в retry_queue и
+    # возвращается в конвейер после паузы; после point_retries попыток она откладывается до
+    # следующего запуска, не попадая ни в processed_coords, ни в список точек без панорам.
+    limiter = AdaptiveRateLimiter(args.rps, args.min_rps, args.max_rps, increase=RPS_INCREASE * args.rps)
+    scheduler = RequestScheduler(limiter, CircuitBreaker(BREAKER_FAILURES, BREAKER_RESET_SECONDS), RetryBudget(), is_transient_api_error,
+                                 telemetry, max_attempts=args.max_attempts, backoff_base=BACKOFF_BASE_SECONDS, backoff_cap=BACKOFF_CAP_SECONDS)
+    fetcher = PanoramaFetcher(year_contexts, scheduler, panorama_cache, raw_store, args.cell_m, telemetry)
+    executor = ThreadPoolExecutor(max_workers=args.workers)
+    image_pipeline = ImagePipeline(args.image_workers)
+    max_in_flight = max(args.workers, args.image_workers) * 2
+    in_flight = deque()
+    retry_queue = []  # куча (не раньше, порядковый номер, задача, попытка)
+    retry_seq = 0
+    point_tasks = iter_point_tasks()
+    current_road_index = None
+    road_name = object_id = None
+    points_deferred = 0
+    telemetry.set_progress(0, points_pending)
+    telemetry.start_reporting()
     try:
-        for road in all_roads_data:
-            road_name, object_id, segment_path = road['name'], road['object_id'], road['path']
-            print(f"\n=================================================")
-            print(f"🛣️  Обрабатываем сегмент: «{road_name}» (ObjectID: {object_id})")
-            
-            sanitized_name = transliterate(road_name).replace(" ", "_").replace("/", "-")
-            
-            for lat, lon in segment_path:
-                if (lat, lon) in processed_coords:
-                    continue
-                coords_processed_this_session += 1
-                print(f"\n📍 Точка: ({lat:.6f}, {lon:.6f}) [{len(processed_coords)}/{total_coords_in_file}]")
-                
-                pano_to_process = None
+        while True:
+            while len(in_flight) < max_in_flight:
+                if retry_queue and retry_queue[0][0] <= time.monotonic():
+                    _, _, task, attempt = heapq.heappop(retry_queue)
+                else:
+                    task, attempt = next(point_tasks, None), 0
+                    if task is None: break
+                in_flight.append((task, attempt, image_pipeline.chain(executor.submit(fetcher.fetch, *task[2:]), lambda pano: raw_store.entry(pano.id))))
+            if not in_flight:
+                if not retry_queue: break
+                # Новых точек нет, остались только ожидающие повтора
+                time.sleep(max(retry_queue[0][0] - time.monotonic(), 0.0))
+                continue
+            task, attempt, future = in_flight.popleft()
+            road_index, road, lat, lon, key, pending_years = task
+
+            # Заголовки сегментов идут по порядку обхода; повторы точек их не переключают
+            if attempt == 0 and road_index != current_road_index:
+                if current_road_index is not None:
+                    streets_processed_this_session += 1
+                    print(f"   ✅ Сегмент «{road_name}» (ObjectID: {object_id}) полностью обработан.")
+                current_road_index = road_index
+                road_name, object_id = road['name'], road['object_id']
+                print(f"\n=================================================")
+                print(f"🛣️  Обрабатываем сегмент: «{road_name}» (ObjectID: {object_id})")
+
+            points_done = min(len(ctx.processed_coords) for ctx in year_contexts.values())
+            retry_label = f" (повтор {attempt}, «{road['name']}»)" if attempt else ""
+            print(f"\n📍 Точка: ({lat:.6f}, {lon:.6f}) [{points_done}/{total_coords_in_file}]{retry_label}")
+            # Ожидание результатов в основном потоке показывает, какая из стадий конвейера не успевает
+            failure = None
+            try:
+                with telemetry.timer("wait_network"): found, notes, image_jobs = future.result()
+            except RetryLater as e:
+                failure = f"API недоступен ({e})"
+            else:
+                # Виды всех лет собираются до записи: при сбое пула точка повторяется целиком, ничего не записав
                 try:
-                    time.sleep(TIME_DELAY)
-                    latest_pano = yandex.find_panorama(lat, lon)
-                    if not latest_pano: raise StopIteration("Панорамы не найдены для этой точки.")
-                    all_panos_at_location = [latest_pano] + getattr(latest_pano, 'historical', [])
-                    
-                    found_pano_for_year = None
-                    for pano_candidate in all_panos_at_location:
-                        pano_date = getattr(pano_candidate, 'date', None) or get_date_from_pano_id(pano_candidate.id)
-                        if pano_date and pano_date.year == int(YEAR):
-                            if pano_candidate.id in logged_pano_ids:
-                                print(f"   ℹ️ Найдена панорама {YEAR} года ({pano_candidate.id}), но она уже в логе.")
-                            else:
-                                print(f"   🎯 Найдена панорама за {YEAR} год! ID: {pano_candidate.id}")
-                                found_pano_for_year = pano_candidate
-                            break 
-                    
-                    if found_pano_for_year:
-                        if getattr(found_pano_for_year, 'image_sizes', None) is None:
-                            print(f"   -> Получаем полную информацию для исторической панорамы...")
-                            time.sleep(TIME_DELAY) 
-                            pano_to_process = yandex.find_panorama_by_id(found_pano_for_year.id)
-                        else:
-                            pano_to_process = found_pano_for_year
-                    else:
-                        print(f"   ℹ️ Панорамы за {YEAR} год не найдены для этой точки.")
-                except StopIteration as e: print(f"   {e}")
-                except Exception as e:
-                    if "Expecting value" in str(e): print(f"   ℹ️ API Яндекса вернул некорректный ответ. Пропускаем точку.")
-                    else: print(f"   ⚠️ Неожиданная ошибка: {e}")
-                
-                if pano_to_process and pano_to_process.image_sizes:
-                    pano = pano_to_process
-                    pano_date = getattr(pano, 'date', None) or get_date_from_pano_id(pano.id)
-                    raw_path = os.path.join(TEMP_DIR, f"{pano.id}.jpg")
-                    if not os.path.exists(raw_path):
-                        print(f"   -> Скачиваем панораму {pano.id}...")
-                        yandex.download_panorama(pano, raw_path, zoom=0)
-                    
-                    img = cv2.imread(raw_path)
-                    if img is not None:
-                        # NEW ROI: Вызываем новую функцию для нарезки
-                        views_to_save = crop_panorama_to_roi(img, YEAR)
-
-                        for view_data in views_to_save:
-                            view_label = view_data["label"]
-                            view_image = view_data["image"]
-                            
-                            pil_img = Image.fromarray(cv2.cvtColor(view_image, cv2.COLOR_BGR2RGB))
-                            h_hash = imagehash.phash(pil_img)
-
-                            if h_hash in image_hashes:
-                                print(f"   ℹ️ Дубликат вида '{view_label}'. Пропускаем.")
-                                continue
-                            
-                            current_id = global_id + 1
-                            filename = f"{YEAR}_{current_id:05d}_{sanitized_name}_{view_label}.jpg"
-                            filepath = os.path.join(output_dir, filename)
-                            
-                            if cv2.imwrite(filepath, view_image):
-                                global_id = current_id
-                                image_hashes.add(h_hash)
-                                logged_pano_ids.add(pano.id) # Добавляем основной ID, чтобы не обрабатывать панораму заново
-                                with open(log_file, "a", newline="", encoding="utf-8") as f_log:
-                                    writer = csv.writer(f_log)
-                                    writer.writerow([global_id, object_id, pano.id, road_name, pano.lat, pano.lon, YEAR, view_label, filepath, pano_date.strftime("%Y-%m-%d %H:%M:%S")])
-                                print(f"   💾 Сохранен вид '{view_label}': {filepath}")
-                    else:
-                        print(f"   × Ошибка чтения изображения из кэша: {raw_path}")
+                    with telemetry.timer("wait_image"):
+                        rendered = {year: image_pipeline.result(job, IMAGE_TIMEOUT_SECONDS) for year, job in image_jobs.items()}
+                except ImagePoolError as e:
+                    for pano in found.values(): fetcher.release(pano.id)
+                    telemetry.count("errors", type="image_pool")
+                    failure = f"Обработка изображений не ответила ({e})"
+                else:
+                    for year, (_, _, band) in rendered.items():
+                        if band: raw_store.put_band(found[year].id, year, band)
+            if failure:
+                if attempt >= args.point_retries:
+                    points_deferred += 1
+                    telemetry.count("points_deferred")
+                    print(f"   ⏭️ {failure}. Точка отложена до следующего запуска.")
                 else:
-                    with open(bad_addresses_file, "a", newline="", encoding="utf-8") as f_bad:
-                        writer = csv.writer(f_bad); writer.writerow([road_name, lat, lon, object_id])
-                
-                processed_coords.add((lat, lon))
-            
+                    delay = POINT_RETRY_BASE_SECONDS + backoff_delay(attempt, POINT_RETRY_BASE_SECONDS, POINT_RETRY_CAP_SECONDS)
+                    heapq.heappush(retry_queue, (time.monotonic() + delay, retry_seq, task, attempt + 1))
+                    retry_seq += 1
+                    telemetry.count("points_requeued")
+                    print(f"   🔁 {failure}. Точка вернется в очередь через {delay:.0f} с.")
+                continue
+            for note in notes: print(note)
+            road_label, road_id = road['name'], road['object_id']
+            sanitized_name = transliterate(road_label).replace(" ", "_").replace("/", "-")
+
+            for year in pending_years:
+                ctx = year_contexts[year]
+                pano = found.get(year)
+                if pano and pano.id in ctx.logged_pano_ids:
+                    # Панораму уже записала точка раньше по порядку обхода: как и при одном воркере, точка без панорамы
+                    print(f"   ℹ️ Панорама {year} года ({pano.id}) уже в логе.")
+                    fetcher.release(pano.id)
+                    pano = None
+                if pano:
+                    telemetry.count("panoramas_found", year=year)
+                    rendered_views, timings, _ = rendered[year]
+                    for stage, seconds in timings.items(): telemetry.observe(stage, seconds)
+                    ctx.save_panorama_views(pano, rendered_views, road_id, road_label, sanitized_name)
+                    fetcher.release(pano.id)
+                    ctx.mark_processed(key)
+                else:
+                    ctx.log_no_panorama(key, road_label, lat, lon, road_id)
+            coords_processed_this_session += 1
+            telemetry.count("points")
+            telemetry.set_progress(coords_processed_this_session, points_pending)
+
+        if current_road_index is not None:
             streets_processed_this_session += 1
             print(f"   ✅ Сегмент «{road_name}» (ObjectID: {object_id}) полностью обработан.")
-    
+
     except KeyboardInterrupt:
         print("\n\n❗️ Процесс прерван пользователем.")
     finally:
-        # ... (блок finally без изменений) ...
+        # Точки, которые еще не дошли до записи, отменяются и будут обработаны при следующем запуске
+        executor.shutdown(wait=False, cancel_futures=True)
+        image_pipeline.shutdown()
         print("\n>>> ЗАВЕРШЕНИЕ РАБОТЫ...")
         session_duration_seconds = time.time() - start_time
-        stats['total_duration_seconds'] += session_duration_seconds
-        state['processed_coords'] = processed_coords
-        state['image_hashes'] = image_hashes
-        state['stats'] = stats
-        with open(state_path, "wb") as f_state: pickle.dump(state, f_state)
-        with open(cache_path, "wb") as f_cache: pickle.dump(panorama_cache, f_cache)
+        for ctx in year_contexts.values(): ctx.save_state(session_duration_seconds)
         print("   -> Финальное состояние сохранено.")
-        
-        m, s = divmod(session_duration_seconds, 60)
-        h, m = divmod(m, 60)
-        session_duration_formatted = f"{int(h):02d}:{int(m):02d}:{int(s):02d}"
-        m_total, s_total = divmod(stats['total_duration_seconds'], 60)
-        h_total, m_total = divmod(m_total, 60)
-        total_duration_formatted = f"{int(h_total):02d}:{int(m_total):02d}:{int(s_total):02d}"
+        telemetry.stop_reporting()
+        telemetry.maybe_report(force=True)
+
+        def format_duration(seconds: float) -> str:
+            m, s = divmod(seconds, 60)
+            h, m = divmod(m, 60)
+            return f"{int(h):02d}:{int(m):02d}:{int(s):02d}"
         print("-" * 50)
         print("📊 ИТОГОВАЯ СТАТИСТИКА:")
-        print(f"🕒 Время выполнения (сессия): {session_duration_formatted}")
-        print(f"🕒 Время выполнения (всего):  {total_duration_formatted}")
+        print(f"🕒 Время выполнения (сессия): {format_duration(session_duration_seconds)}")
         print(f"🛣️  Сегментов обработано (сессия):  {streets_processed_this_session}")
-        print(f"📍 Координат (всего):         {len(processed_coords)} / {total_coords_in_file}")
-        print(f"🖼️  Сохранено фото (всего):     {global_id}")
+        pending_retries = len(retry_queue) + sum(1 for _, attempt, _ in in_flight if attempt)
+        if points_deferred or pending_retries:
+            print(f"⏭️  Отложено до следующего запуска: {points_deferred + pending_retries} точек (API или пул изображений не ответили)")
+        for ctx in year_contexts.values():
+            if len(year_contexts) > 1: print(f"📅 {ctx.year}:")
+            print(f"🕒 Время выполнения (всего):  {format_duration(ctx.stats['total_duration_seconds'])}")
+            print(f"📍 Координат (всего):         {len(ctx.processed_coords)} / {total_coords_in_file}")
+            print(f"🖼️  Сохранено фото (всего):     {ctx.global_id}")
+        print(f"🗄️  Кэш метаданных (сессия):    попаданий {panorama_cache.hits}, промахов {panorama_cache.misses}")
+        print(f"🗂️  Исходники панорам (сессия): найдено {raw_store.hits}, скачано {raw_store.misses}, "
+              f"вытеснено {raw_store.evicted_files} ({raw_store.evicted_bytes / 1e9:.2f} ГБ), сейчас {raw_store.total_bytes / 1e9:.2f} ГБ")
+        print("-" * 50)
+        print("⏱️  СТАДИИ И СЧЕТЧИКИ (сессия):")
+        for line in telemetry.summary_lines(): print(f"   {line}")
         print("-" * 50)
         print(">>> ФИНИШ")
 
 
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,76 @@
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from typing import Optional, Tuple
+
+
+class PanoramaCache:
+    """
+    Дисковый кэш метаданных панорам (SQLite в режиме WAL).
+
+    Хранит два вида ответов API:
+      * lookups   - результат find_panorama (последняя панорама вместе с historical) по ячейке сетки;
+      * panoramas - результат find_panorama_by_id по ID панорамы.
+    Ответы не зависят от года, поэтому кэш общий для всех лет и процессов. Отсутствие панорамы
+    тоже кэшируется, ошибки API - нет. Записи старше ttl_seconds считаются промахом (0 - без срока).
+    """
+    def __init__(self, path: str, ttl_seconds: float = 0):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        self._counter_lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        conn = self._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS lookups (cell_m REAL, row INTEGER, col INTEGER, result BLOB, fetched_at REAL, "
+                     "PRIMARY KEY (cell_m, row, col))")
+        conn.execute("CREATE TABLE IF NOT EXISTS panoramas (pano_id TEXT PRIMARY KEY, result BLOB, fetched_at REAL)")
+        conn.commit()
+
+    def _conn(self) -> sqlite3.Connection:
+        # Отдельное соединение на поток: sqlite3-соединения нельзя делить между потоками
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _fresh(self, fetched_at: float) -> bool:
+        return not self.ttl_seconds or time.time() - fetched_at < self.ttl_seconds
+
+    def _count(self, hit: bool) -> None:
+        with self._counter_lock:
+            if hit: self.hits += 1
+            else: self.misses += 1
+
+    def _get(self, query: str, params: tuple) -> Tuple[bool, Optional[object]]:
+        row = self._conn().execute(query, params).fetchone()
+        if row is None or not self._fresh(row[1]):
+            self._count(False)
+            return False, None
+        self._count(True)
+        return True, pickle.loads(row[0])
+
+    def _put(self, query: str, params: tuple) -> None:
+        conn = self._conn()
+        with conn: conn.execute(query, params)
+
+    def get_lookup(self, cell: Tuple[int, int], cell_m: float) -> Tuple[bool, Optional[object]]:
+        """Возвращает (найдено_в_кэше, панорама). Панорама может быть None, если в ячейке ее нет."""
+        return self._get("SELECT result, fetched_at FROM lookups WHERE cell_m = ? AND row = ? AND col = ?", (cell_m, *cell))
+
+    def put_lookup(self, cell: Tuple[int, int], cell_m: float, pano: Optional[object]) -> None:
+        self._put("INSERT OR REPLACE INTO lookups VALUES (?, ?, ?, ?, ?)",
+                  (cell_m, *cell, pickle.dumps(pano, protocol=pickle.HIGHEST_PROTOCOL), time.time()))
+
+    def get_pano(self, pano_id: str) -> Tuple[bool, Optional[object]]:
+        return self._get("SELECT result, fetched_at FROM panoramas WHERE pano_id = ?", (pano_id,))
+
+    def put_pano(self, pano_id: str, pano: Optional[object]) -> None:
+        self._put("INSERT OR REPLACE INTO panoramas VALUES (?, ?, ?)",
+                  (pano_id, pickle.dumps(pano, protocol=pickle.HIGHEST_PROTOCOL), time.time()))
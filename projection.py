@@ -0,0 +1,125 @@
+import json
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+# Профили обрезки для разных лет: наклон камеры и доли кадра, которые остаются после обрезки
+PROFILES = {
+    "default": {"v_deg": -20, "top_frac": 0.5, "end_frac": 1.0, "sub_crop": 0.3},
+    "2017": {"v_deg": -7, "top_frac": 0.4, "end_frac": 0.9, "sub_crop": 0.1}
+}
+VIEWS = [(180, "front"), (0, "back")]
+FOV_DEG = 70
+OUT_HW = (1536, 1536)
+
+
+def get_profile(year: str) -> dict:
+    return PROFILES.get(year, PROFILES["default"])
+
+
+def crop_rows(profile: dict, out_h: int = OUT_HW[0]) -> Tuple[int, int]:
+    """Диапазон строк полного перспективного кадра, который переживает top_frac/end_frac/sub_crop."""
+    top_px = int(out_h * profile["top_frac"])
+    end_px = int(out_h * profile["end_frac"])
+    sub_crop_px = int((end_px - top_px) * profile["sub_crop"])
+    return top_px + sub_crop_px, end_px
+
+
+def source_coords(in_h: int, in_w: int, yaw: float, v_deg: float, row_start: int, row_end: int,
+                  fov_deg: float = FOV_DEG, out_hw: Tuple[int, int] = OUT_HW) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Координаты (x, y) пикселей панорамы in_h x in_w для строк [row_start, row_end) перспективного кадра out_hw.
+    Геометрия повторяет py360convert.e2p (xyzpers -> xyz2uv -> uv2coor).
+    """
+    out_h, out_w = out_hw
+    half_fov = np.deg2rad(fov_deg) / 2
+    x_rng = np.linspace(-np.tan(half_fov), np.tan(half_fov), num=out_w, dtype=np.float32)
+    y_rng = np.linspace(-np.tan(half_fov), np.tan(half_fov), num=out_h, dtype=np.float32)[row_start:row_end]
+    xx, yy = np.meshgrid(x_rng, -y_rng)
+    xyz = np.stack([xx, yy, np.ones_like(xx)], axis=-1)
+
+    u, v = -np.deg2rad(yaw), np.deg2rad(v_deg)
+    rx = np.array([[1, 0, 0], [0, np.cos(v), -np.sin(v)], [0, np.sin(v), np.cos(v)]])
+    ry = np.array([[np.cos(u), 0, np.sin(u)], [0, 1, 0], [-np.sin(u), 0, np.cos(u)]])
+    xyz = xyz.dot(rx).dot(ry).astype(np.float32)
+
+    x, y, z = xyz[..., 0], xyz[..., 1], xyz[..., 2]
+    lon = np.arctan2(x, z)
+    lat = np.arctan2(y, np.hypot(x, z))
+    coor_x = (lon / (2 * np.pi) + 0.5) * in_w - 0.5
+    coor_y = (-lat / np.pi + 0.5) * in_h - 0.5
+    return coor_x.astype(np.float32), coor_y.astype(np.float32)
+
+
+@lru_cache(maxsize=32)
+def remap_tables(in_h: int, in_w: int, yaw: float, v_deg: float, row_start: int, row_end: int,
+                 fov_deg: float = FOV_DEG, out_hw: Tuple[int, int] = OUT_HW, row_offset: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Таблицы cv2.remap для строк [row_start, row_end) перспективного кадра out_hw. Считаются один раз
+    на (размер панорамы, профиль, yaw) и только для строк, которые останутся после обрезки.
+    row_offset - первая строка панорамы в изображении, если хранится только полоса ROI (см. roi_tiles).
+    """
+    coor_x, coor_y = source_coords(in_h, in_w, yaw, v_deg, row_start, row_end, fov_deg, out_hw)
+    map1, map2 = cv2.convertMaps(coor_x, coor_y - np.float32(row_offset), cv2.CV_16SC2)
+    map1.setflags(write=False)
+    map2.setflags(write=False)
+    return map1, map2
+
+
+def project_view(img: np.ndarray, yaw: float, profile: dict, row_offset: int = 0, full_height: Optional[int] = None) -> np.ndarray:
+    row_start, row_end = crop_rows(profile)
+    map1, map2 = remap_tables(full_height or img.shape[0], img.shape[1], yaw, profile["v_deg"], row_start, row_end, row_offset=row_offset)
+    # BORDER_WRAP заменяет паддинг e2p: вид "front" (yaw=180) проходит через шов панорамы
+    return cv2.remap(img, map1, map2, interpolation=cv2.INTER_LINEAR, borderMode=cv2.BORDER_WRAP)
+
+
+#Функция для нарезки панорамы на виды "вперед" и "назад"
+def crop_panorama_to_roi(img: np.ndarray, year: str, row_offset: int = 0, full_height: Optional[int] = None) -> List[dict]:
+    """
+    Принимает панораму, нарезает ее на перспективные виды (вперед/назад)
+    и возвращает список словарей, каждый из которых содержит вид и его название.
+    Если img - только полоса панорамы высотой full_height, начинающаяся со строки row_offset
+    (см. roi_tiles), виды строятся из тех же пикселей, что и из полной панорамы.
+    """
+    profile = get_profile(year)
+    return [{"label": view_label, "image": project_view(img, yaw, profile, row_offset, full_height)} for yaw, view_label in VIEWS]
+
+
+@lru_cache(maxsize=32)
+def roi_tiles(in_h: int, in_w: int, tile_w: int, tile_h: int, year: str) -> Tuple[Tuple[int, int], ...]:
+    """
+    Тайлы (x, y) панорамы, из которых берутся пиксели видов года: остальная часть панорамы
+    (небо, бока, низ) для нарезки не нужна. Учитываются соседи для билинейной интерполяции
+    и запас в пиксель на округление таблиц remap.
+    """
+    profile = get_profile(year)
+    row_start, row_end = crop_rows(profile)
+    used = np.zeros((-(-in_h // tile_h), -(-in_w // tile_w)), dtype=bool)
+    for yaw, _ in VIEWS:
+        coor_x, coor_y = source_coords(in_h, in_w, yaw, profile["v_deg"], row_start, row_end)
+        x0, y0 = np.floor(coor_x).astype(np.int32), np.floor(coor_y).astype(np.int32)
+        for dx in (-1, 0, 1, 2):
+            cols = ((x0 + dx) % in_w) // tile_w
+            for dy in (-1, 0, 1, 2):
+                used[np.clip(y0 + dy, 0, in_h - 1) // tile_h, cols] = True
+    rows, cols = np.nonzero(used)
+    return tuple(sorted(zip(cols.tolist(), rows.tolist())))
+
+
+def roi_key(year: str) -> str:
+    """Отпечаток геометрии видов года: полоса ROI, сохраненная под другой профиль, не подходит."""
+    return json.dumps([FOV_DEG, OUT_HW, VIEWS, get_profile(year)], sort_keys=True)
+
+
+def crop_panorama_to_roi_e2p(img: np.ndarray, year: str) -> List[dict]:
+    """Прежняя реализация через py360convert.e2p: эталон для сверки и бенчмарка."""
+    from py360convert import e2p
+    profile = get_profile(year)
+    row_start, row_end = crop_rows(profile)
+    output_views = []
+    for yaw, view_label in VIEWS:
+        view = e2p(img, fov_deg=FOV_DEG, u_deg=yaw, v_deg=profile["v_deg"], out_hw=OUT_HW)
+        output_views.append({"label": view_label, "image": view[row_start:row_end, :, :]})
+    return output_views
@@ -0,0 +1,225 @@
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator
+
+
+class TokenBucket:
+    """
+    Потокобезопасный token bucket. Один экземпляр делится между всеми воркерами
+    и ограничивает суммарное число запросов к API в секунду.
+    """
+    def __init__(self, rate: float, burst: int = 1):
+        if rate <= 0:
+            raise ValueError(f"Лимит запросов должен быть > 0, получено: {rate}")
+        self.rate = rate
+        self.capacity = max(1, int(burst))
+        self._tokens = float(self.capacity)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def acquire(self) -> None:
+        """Блокирует вызывающий поток, пока в корзине не появится токен."""
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class AdaptiveRateLimiter(TokenBucket):
+    """
+    Token bucket с AIMD-регулировкой лимита: пока ответы успешные, лимит растет примерно на
+    increase запросов в секунду за каждую секунду работы; на ошибке перегрузки умножается на
+    decrease. Серия ошибок подряд снижает лимит не чаще раза в cooldown_seconds, иначе один
+    всплеск обвалил бы его до min_rate.
+    """
+    def __init__(self, rate: float, min_rate: float, max_rate: float, increase: float = 0.05,
+                 decrease: float = 0.5, cooldown_seconds: float = 2.0, burst: int = 1):
+        if not 0 < min_rate <= rate <= max_rate:
+            raise ValueError(f"Ожидается 0 < min_rate <= rate <= max_rate, получено: {min_rate}, {rate}, {max_rate}")
+        super().__init__(rate, burst)
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown_seconds = cooldown_seconds
+        self._last_decrease = 0.0
+
+    def on_success(self) -> None:
+        with self._lock:
+            self._refill()
+            # +increase/rate на каждый ответ: при rate ответов в секунду это +increase в секунду
+            self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+
+    def on_failure(self) -> bool:
+        """Снижает лимит; возвращает True, если снижение произошло (а не попало в cooldown)."""
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_decrease < self.cooldown_seconds: return False
+            self._refill()
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self._last_decrease = now
+            return True
+
+
+class CircuitBreaker:
+    """
+    Размыкатель: после failure_threshold ошибок подряд все вызовы ждут reset_seconds, затем
+    проходит один пробный запрос. Успех замыкает цепь, ошибка снова размыкает ее на вдвое
+    больший срок (не больше max_reset_seconds).
+    """
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_seconds: float = 30.0, max_reset_seconds: float = 300.0):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.max_reset_seconds = max_reset_seconds
+        self.state = self.CLOSED
+        self._failures = 0
+        self._open_seconds = reset_seconds
+        self._open_until = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def before_call(self) -> float:
+        """Блокирует, пока цепь разомкнута или идет пробный запрос; возвращает время ожидания, с."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if self.state == self.CLOSED: return waited
+                if self.state == self.OPEN and now >= self._open_until:
+                    self.state = self.HALF_OPEN
+                if self.state == self.HALF_OPEN and not self._probe_in_flight:
+                    self._probe_in_flight = True
+                    return waited
+                wait = max(self._open_until - now, 0.05) if self.state == self.OPEN else 0.05
+            time.sleep(wait)
+            waited += wait
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.state = self.CLOSED
+            self._failures = 0
+            self._open_seconds = self.reset_seconds
+            self._probe_in_flight = False
+
+    def record_failure(self) -> bool:
+        """Учитывает ошибку; возвращает True, если цепь только что разомкнулась."""
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN:
+                self._open_seconds = min(self._open_seconds * 2, self.max_reset_seconds)
+            elif self.state == self.OPEN or self._failures < self.failure_threshold:
+                return False
+            self.state = self.OPEN
+            self._open_until = time.monotonic() + self._open_seconds
+            self._probe_in_flight = False
+            return True
+
+
+class RetryBudget:
+    """
+    Бюджет повторов: каждый успешный запрос добавляет ratio токена (не больше max_tokens),
+    каждый повтор тратит один. Когда сервер лежит, повторы быстро заканчиваются и не
+    превращаются в шторм запросов.
+    """
+    def __init__(self, ratio: float = 0.2, initial: float = 10.0, max_tokens: float = 50.0):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self._tokens = min(initial, max_tokens)
+        self._lock = threading.Lock()
+
+    def on_success(self) -> None:
+        with self._lock: self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def try_spend(self) -> bool:
+        with self._lock:
+            if self._tokens < 1: return False
+            self._tokens -= 1
+            return True
+
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """Экспоненциальная задержка с полным джиттером: равномерно в [0, min(cap, base * 2^attempt)]."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class RetryLater(Exception):
+    """Временная ошибка API, которая не прошла и после повторов: запрос стоит повторить позже."""
+
+
+class RequestScheduler:
+    """
+    Все запросы к API: размыкатель, адаптивный лимит, замер вызова и повторы временных ошибок
+    с экспоненциальной задержкой в пределах max_attempts и общего RetryBudget. Какие ошибки
+    временные, решает is_transient. Если повторы исчерпаны, поднимается RetryLater; остальные
+    ошибки пробрасываются как есть.
+    """
+    def __init__(self, limiter: AdaptiveRateLimiter, breaker: CircuitBreaker, budget: RetryBudget,
+                 is_transient: Callable[[Exception], bool], telemetry=None, max_attempts: int = 4,
+                 backoff_base: float = 1.0, backoff_cap: float = 30.0):
+        self.limiter = limiter
+        self.breaker = breaker
+        self.budget = budget
+        self.is_transient = is_transient
+        self.telemetry = telemetry
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+
+    @contextmanager
+    def _timer(self, stage: str) -> Iterator[None]:
+        if self.telemetry is None:
+            yield
+        else:
+            with self.telemetry.timer(stage): yield
+
+    def _count(self, name: str, **labels: str) -> None:
+        if self.telemetry is not None: self.telemetry.count(name, **labels)
+
+    def _publish_state(self) -> None:
+        if self.telemetry is not None:
+            self.telemetry.gauge("rate_limit_rps", round(self.limiter.rate, 3))
+            self.telemetry.gauge("circuit_open", 0 if self.breaker.state == CircuitBreaker.CLOSED else 1)
+
+    def call(self, stage: str, fn: Callable, *args, **kwargs):
+        attempt = 0
+        while True:
+            with self._timer("circuit_wait"): self.breaker.before_call()
+            with self._timer("rate_limit_wait"): self.limiter.acquire()
+            try:
+                with self._timer(stage): result = fn(*args, **kwargs)
+            except Exception as e:
+                if not self.is_transient(e):
+                    # Ответ получен, просто не тот: о перегрузке сервера это не говорит
+                    self.breaker.record_success()
+                    raise
+                self.limiter.on_failure()
+                if self.breaker.record_failure():
+                    self._count("circuit_opened")
+                    print(f"   🔌 {self.breaker.failure_threshold} ошибок API подряд, запросы приостановлены. "
+                          f"Лимит снижен до {self.limiter.rate:.2f} запр./с.")
+                self._publish_state()
+                attempt += 1
+                if attempt >= self.max_attempts or not self.budget.try_spend():
+                    self._count("retries_exhausted", stage=stage)
+                    raise RetryLater(f"{stage}: {e}") from e
+                self._count("retries", stage=stage)
+                time.sleep(backoff_delay(attempt, self.backoff_base, self.backoff_cap))
+                continue
+            self.limiter.on_success()
+            self.breaker.record_success()
+            self.budget.on_success()
+            self._publish_state()
+            return result
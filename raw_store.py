@@ -0,0 +1,288 @@
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import cv2
+import numpy as np
+from streetlevel import util as streetlevel_util
+from streetlevel.dataclasses import Tile
+
+from projection import roi_key, roi_tiles
+
+STORE_MODES = ["full", "band", "roi"]
+EVICTION_POLICIES = ["lru", "lfu"]
+TILE_URL = "https://pano.maps.yandex.net/{0}/{1}.{2}.{3}"  # как в streetlevel.yandex
+BAND_JPEG_QUALITY = 95  # полоса перекодируется: виды из нее отличаются от видов из полной панорамы на шум JPEG
+EVICT_TO_FRACTION = 0.9  # вытеснение идет с запасом, чтобы не срабатывать на каждой загрузке
+PIN_LEASE_SECONDS = 3600.0  # захват исходника в индексе; захваты упавших процессов истекают сами
+
+
+class RawEntry(NamedTuple):
+    """
+    Исходник панорамы на диске. Для полосы ROI - первая строка и высота полной панорамы.
+    band_path задан у полной панорамы в режиме band: туда обработка запишет полосу (см. put_band).
+    """
+    path: str
+    row_offset: int = 0
+    full_height: Optional[int] = None
+    band_path: Optional[str] = None
+
+
+class RawPanoramaStore:
+    """
+    Хранилище исходников панорам в TEMP_DIR с ограничением по размеру.
+
+    Режимы:
+      * full - полная равнопромежуточная панорама, как ее отдает download_panorama;
+      * band - полная панорама скачивается, но хранится только полоса с тайлами ROI года
+        (остальные тайлы зачернены, JPEG почти ничего на них не тратит). Полосу вырезает
+        процесс обработки изображений, который все равно декодирует панораму, а не сетевой поток;
+      * roi  - скачиваются только тайлы ROI, хранится такая же полоса.
+    Полоса покрывает все пиксели, из которых режутся виды (см. projection.roi_tiles), но сохраняется
+    заново в JPEG с качеством BAND_JPEG_QUALITY: виды из нее совпадают с видами из полной панорамы
+    с точностью до шума перекодирования (на тестовых панорамах - до 12 уровней из 255, pHash - до 2 бит).
+
+    Индекс файлов лежит в SQLite (WAL) рядом с панорамами: размер, уровень зума, время последнего
+    использования и число использований. Исходник годится, только если его зум не грубее текущего:
+    после прогона с --raw-zoom 2 прогон с --raw-zoom 0 скачает панораму заново. Когда сумма превышает max_bytes, вытесняются
+    файлы по политике lru или lfu, кроме тех, что сейчас в работе (acquire/put до release).
+    Захваты записываются в индекс (таблица pins, аренда на PIN_LEASE_SECONDS), поэтому их
+    учитывают и другие процессы с тем же TEMP_DIR. max_bytes = 0 - без ограничения.
+    Файлы, скачанные до появления индекса, подхватываются при первом запуске как полные панорамы.
+    """
+    def __init__(self, root: str, mode: str = "full", zoom: int = 0, max_bytes: int = 0, policy: str = "lru"):
+        self.root = root
+        self.mode = mode
+        self.zoom = zoom
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.hits = 0
+        self.misses = 0
+        self.evicted_files = 0
+        self.evicted_bytes = 0
+        self._pinned: Dict[str, List] = {}  # pano_id -> [число захватов, RawEntry]
+        self._owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._lease_lock = threading.Lock()
+        self._evict_lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        conn = self._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS raw (pano_id TEXT PRIMARY KEY, path TEXT, bytes INTEGER, kind TEXT, "
+                     "roi TEXT, zoom INTEGER, row_offset INTEGER, full_height INTEGER, last_used REAL, uses INTEGER)")
+        conn.execute("CREATE TABLE IF NOT EXISTS pins (pano_id TEXT, owner TEXT, until REAL, PRIMARY KEY (pano_id, owner)) WITHOUT ROWID")
+        conn.commit()
+        if conn.execute("SELECT COUNT(*) FROM raw").fetchone()[0] == 0: self._import_untracked()
+        self.total_bytes = conn.execute("SELECT COALESCE(SUM(bytes), 0) FROM raw").fetchone()[0]
+
+    def _conn(self) -> sqlite3.Connection:
+        # Отдельное соединение на поток: sqlite3-соединения нельзя делить между потоками
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(os.path.join(self.root, "raw_store.sqlite"), timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _import_untracked(self) -> None:
+        rows = []
+        for entry in os.scandir(self.root):
+            if entry.is_file() and entry.name.endswith(".jpg") and not entry.name.endswith((".part.jpg", ".band.jpg")):
+                stat = entry.stat()
+                rows.append((entry.name[:-len(".jpg")], entry.path, stat.st_size, "full", None, 0, 0, None, stat.st_mtime, 0))
+        if not rows: return
+        conn = self._conn()
+        with conn: conn.executemany("INSERT OR IGNORE INTO raw VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        print(f"🗂️  В хранилище панорам учтено {len(rows)} ранее скачанных файлов.")
+
+    def tmp_path(self, pano_id: str) -> str:
+        # Временный файл: прерванная загрузка не должна выглядеть как готовый исходник
+        return os.path.join(self.root, f"{pano_id}.part.jpg")
+
+    def _pin(self, conn: sqlite3.Connection, pano_id: str) -> None:
+        # Счетчик захватов в процессе и аренда в индексе меняются вместе, иначе release
+        # соседнего потока может снять аренду, которую только что продлил этот захват
+        with self._lease_lock:
+            with self._lock: self._pinned.setdefault(pano_id, [0, None])[0] += 1
+            with conn: conn.execute("INSERT OR REPLACE INTO pins VALUES (?, ?, ?)", (pano_id, self._owner, time.time() + PIN_LEASE_SECONDS))
+
+    def _unpin(self, conn: sqlite3.Connection, pano_id: str) -> None:
+        with self._lease_lock:
+            with self._lock:
+                pinned = self._pinned.get(pano_id)
+                if pinned is None: return
+                pinned[0] -= 1
+                if pinned[0] > 0: return
+                del self._pinned[pano_id]
+            with conn: conn.execute("DELETE FROM pins WHERE pano_id = ? AND owner = ?", (pano_id, self._owner))
+            if self.mode == "band": self._remove_replaced_full(conn, pano_id)
+
+    def _remove_replaced_full(self, conn: sqlite3.Connection, pano_id: str) -> None:
+        # Полный файл, замененный полосой (put_band), мог взять в работу и другой процесс:
+        # удаляет тот, кто отпускает панораму последним
+        path = os.path.join(self.root, f"{pano_id}.jpg")
+        if not os.path.exists(path): return
+        row = conn.execute("SELECT path FROM raw WHERE pano_id = ?", (pano_id,)).fetchone()
+        if row is None or row[0] == path: return
+        if conn.execute("SELECT 1 FROM pins WHERE pano_id = ? AND until > ?", (pano_id, time.time())).fetchone(): return
+        try: os.remove(path)
+        except FileNotFoundError: pass
+
+    def _set_entry(self, pano_id: str, entry: RawEntry) -> RawEntry:
+        if self.mode == "band" and entry.full_height is None:
+            entry = entry._replace(band_path=os.path.join(self.root, f"{pano_id}.band.jpg"))
+        with self._lock: self._pinned[pano_id][1] = entry
+        return entry
+
+    def acquire(self, pano_id: str, year: str) -> Optional[RawEntry]:
+        """
+        Исходник, пригодный для видов года, или None, если его нужно скачать. Полная панорама
+        подходит, если ее зум не грубее текущего, полоса - еще и только под ту же геометрию ROI.
+        Найденный файл не вытесняется до release.
+        """
+        conn = self._conn()
+        # Аренда берется до чтения строки: вытеснение в другом процессе после этого файл уже не удалит
+        self._pin(conn, pano_id)
+        row = conn.execute("SELECT path, kind, roi, row_offset, full_height, zoom FROM raw WHERE pano_id = ?", (pano_id,)).fetchone()
+        usable = row is not None and (row[5] or 0) <= self.zoom and (row[1] == "full" or (self.mode != "full" and row[2] == roi_key(year))) \
+            and os.path.exists(row[0])
+        with self._lock:
+            if usable: self.hits += 1
+            else: self.misses += 1
+        if not usable:
+            self._unpin(conn, pano_id)
+            return None
+        with conn: conn.execute("UPDATE raw SET last_used = ?, uses = uses + 1 WHERE pano_id = ?", (time.time(), pano_id))
+        return self._set_entry(pano_id, RawEntry(row[0], row[3] or 0, row[4]))
+
+    def put(self, pano_id: str, tmp_path: str, year: str, band: Optional[Tuple[int, int]] = None, zoom: Optional[int] = None) -> RawEntry:
+        """
+        Переносит скачанный tmp_path в хранилище; band = (первая строка, высота полной панорамы)
+        для полосы ROI, zoom - уровень, который реально скачан (см. effective_zoom; по умолчанию
+        зум хранилища). Файл захватывается до release, затем при необходимости идет вытеснение.
+        """
+        path = os.path.join(self.root, f"{pano_id}.band.jpg" if band else f"{pano_id}.jpg")
+        conn = self._conn()
+        self._pin(conn, pano_id)
+        os.replace(tmp_path, path)
+        size = os.path.getsize(path)
+        entry = RawEntry(path, *band) if band else RawEntry(path)
+        with conn:
+            old = conn.execute("SELECT path, bytes FROM raw WHERE pano_id = ?", (pano_id,)).fetchone()
+            conn.execute("INSERT OR REPLACE INTO raw VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         (pano_id, path, size, "band" if band else "full", roi_key(year) if band else None,
+                          self.zoom if zoom is None else zoom, entry.row_offset, entry.full_height, time.time(), 1))
+        if old and old[0] != path and os.path.exists(old[0]): os.remove(old[0])
+        with self._lock: self.total_bytes += size - (old[1] if old else 0)
+        entry = self._set_entry(pano_id, entry)
+        self._maybe_evict()
+        return entry
+
+    def put_band(self, pano_id: str, year: str, band: Tuple[int, int]) -> None:
+        """
+        Заменяет в индексе полную панораму полосой, которую обработка записала в entry.band_path;
+        band = (первая строка полосы, высота полной панорамы). Полный файл удаляется, когда панораму
+        отпустят все, кто взял его в работу.
+        """
+        path = os.path.join(self.root, f"{pano_id}.band.jpg")
+        size = os.path.getsize(path)
+        conn = self._conn()
+        with conn:
+            old = conn.execute("SELECT bytes FROM raw WHERE pano_id = ? AND path = ?", (pano_id, os.path.join(self.root, f"{pano_id}.jpg"))).fetchone()
+            # Полосу той же панорамы могла уже записать параллельная точка или другой процесс
+            if old: conn.execute("UPDATE raw SET path = ?, bytes = ?, kind = 'band', roi = ?, row_offset = ?, full_height = ? WHERE pano_id = ?",
+                                 (path, size, roi_key(year), band[0], band[1], pano_id))
+        if old:
+            with self._lock: self.total_bytes += size - old[0]
+
+    def entry(self, pano_id: str) -> RawEntry:
+        """Исходник захваченной панорамы (после acquire или put)."""
+        with self._lock: return self._pinned[pano_id][1]
+
+    def release(self, pano_id: str) -> None:
+        self._unpin(self._conn(), pano_id)
+
+    def _maybe_evict(self) -> None:
+        if not self.max_bytes or self.total_bytes <= self.max_bytes: return
+        # Вытесняет один поток; остальные не ждут его и продолжают загрузки
+        if not self._evict_lock.acquire(blocking=False): return
+        try: self._evict()
+        finally: self._evict_lock.release()
+
+    def _evict(self) -> None:
+        conn = self._conn()
+        # Файлы могли добавить другие процессы: перед вытеснением размер берется из индекса
+        self.total_bytes = conn.execute("SELECT COALESCE(SUM(bytes), 0) FROM raw").fetchone()[0]
+        target = self.max_bytes * EVICT_TO_FRACTION
+        order = "last_used" if self.policy == "lru" else "uses, last_used"
+        now = time.time()
+        with conn: conn.execute("DELETE FROM pins WHERE until <= ?", (now,))
+        for pano_id, path, size in conn.execute(f"SELECT pano_id, path, bytes FROM raw ORDER BY {order}").fetchall():
+            if self.total_bytes <= target: break
+            # Захваты любого процесса проверяются в той же транзакции, что и удаление строки
+            with conn:
+                deleted = conn.execute("DELETE FROM raw WHERE pano_id = ? AND NOT EXISTS "
+                                       "(SELECT 1 FROM pins WHERE pins.pano_id = ? AND until > ?)", (pano_id, pano_id, now)).rowcount
+            if not deleted: continue
+            try: os.remove(path)
+            except FileNotFoundError: pass
+            with self._lock:
+                self.total_bytes -= size
+                self.evicted_files += 1
+                self.evicted_bytes += size
+
+
+def effective_zoom(pano, zoom: int) -> int:
+    """
+    Уровень зума, который реально есть у панорамы: запрошенный или ближайший к нему доступный
+    (так же зум приводит streetlevel). Его передают в обе загрузки и записывают в индекс.
+    """
+    if not pano.image_sizes: raise ValueError("pano.image_sizes is None.")
+    return max(0, min(zoom, len(pano.image_sizes) - 1))
+
+
+def tile_rows(tiles: Tuple[Tuple[int, int], ...], tile_h: int, full_height: int) -> Tuple[int, int]:
+    """Строки [начало, конец) полной панорамы, которые покрывают тайлы."""
+    rows = [y for _, y in tiles]
+    return min(rows) * tile_h, min((max(rows) + 1) * tile_h, full_height)
+
+
+def crop_to_band(img: np.ndarray, year: str, tile_w: int, tile_h: int) -> Tuple[np.ndarray, int]:
+    """
+    Полоса тайлов ROI года из декодированной полной панорамы (остальные тайлы зачернены).
+    Возвращает (полоса, ее первая строка в полной панораме).
+    """
+    height, width = img.shape[:2]
+    tiles = roi_tiles(height, width, tile_w, tile_h, year)
+    row_start, row_end = tile_rows(tiles, tile_h, height)
+    band = np.zeros((row_end - row_start, width, 3), dtype=np.uint8)
+    for x, y in tiles:
+        y0, y1 = y * tile_h, min((y + 1) * tile_h, height)
+        band[y0 - row_start:y1 - row_start, x * tile_w:(x + 1) * tile_w] = img[y0:y1, x * tile_w:(x + 1) * tile_w]
+    return band, row_start
+
+
+def download_roi_band(pano, year: str, zoom: int, path: str) -> Tuple[Tuple[int, int], int]:
+    """
+    Скачивает только тайлы ROI года и сшивает из них полосу панорамы в path.
+    Возвращает ((первая строка полосы, высота полной панорамы), скачано байт).
+    """
+    zoom = effective_zoom(pano, zoom)
+    size, tile_w, tile_h = pano.image_sizes[zoom], pano.tile_size.x, pano.tile_size.y
+    tiles = roi_tiles(size.y, size.x, tile_w, tile_h, year)
+    row_start, row_end = tile_rows(tiles, tile_h, size.y)
+    # Тайлы качаются параллельно тем же кодом streetlevel, что и полная панорама
+    images = streetlevel_util.download_tiles([Tile(x, y, TILE_URL.format(pano.image_id, zoom, x, y)) for x, y in tiles])
+    band = np.zeros((row_end - row_start, size.x, 3), dtype=np.uint8)
+    for (x, y), data in images.items():
+        tile = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if tile is None: raise ValueError(f"Не удалось декодировать тайл {x}.{y} панорамы {pano.id}")
+        y0 = y * tile_h - row_start
+        tile = tile[:min(tile_h, row_end - row_start - y0), :min(tile_w, size.x - x * tile_w)]
+        band[y0:y0 + tile.shape[0], x * tile_w:x * tile_w + tile.shape[1]] = tile
+    cv2.imwrite(path, band, [cv2.IMWRITE_JPEG_QUALITY, BAND_JPEG_QUALITY])
+    return (row_start, size.y), sum(len(data) for data in images.values())
@@ -0,0 +1,230 @@
+"""
+Загрузка дорожных сегментов из CSV-выгрузки (almaty_roads.csv и аналогичных).
+
+CSV с WKT разбирается один раз и компилируется в бинарный кэш рядом с исходником
+(<имя>.roadcache/): координаты всех сегментов лежат одним массивом float64 (lat, lon),
+границы сегментов - массивом смещений. Следующие запуски открывают массивы через mmap
+и выдают сегменты генератором, не держа в памяти всю выгрузку в виде Python-объектов.
+Кэш сбрасывается, если у CSV изменились размер или mtime и при этом изменилось содержимое (SHA-1).
+
+Модуль общий для mainn.py и generate_map.py, поэтому не зависит от streetlevel и folium.
+"""
+import os
+import re
+import math
+import csv
+import json
+import shutil
+import hashlib
+from array import array
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+
+CACHE_VERSION = 1
+WKT_PAIR_RE = re.compile(r"([-\d\.]+)\s+([-\d\.]+)")
+ITER_BLOCK = 1024  # сегментов на одно преобразование numpy -> Python при обходе
+ARRAYS = ("coords", "offsets", "names_utf8", "name_offsets", "ids_utf8", "id_offsets")
+METERS_PER_DEG_LAT = 111320.0
+
+
+def fix_encoding(s: str) -> str:
+    if not isinstance(s, str) or not s: return s
+    try: return s.encode("cp1251").decode("utf-8")
+    except Exception: return s
+
+
+def parse_wkt_coords(geom: str) -> List[Tuple[float, float]]:
+    """Пары (lat, lon) из WKT (в WKT порядок 'lon lat')."""
+    return [(float(lat), float(lon)) for lon, lat in WKT_PAIR_RE.findall(geom)]
+
+
+def cell_key(lat: float, lon: float, cell_m: float) -> Tuple[int, int]:
+    """Ключ ячейки сетки ~cell_m x cell_m метров. Ширина ячейки по долготе считается по центру ее ряда."""
+    row = math.floor(lat * METERS_PER_DEG_LAT / cell_m)
+    row_center_lat = (row + 0.5) * cell_m / METERS_PER_DEG_LAT
+    col = math.floor(lon * METERS_PER_DEG_LAT * math.cos(math.radians(row_center_lat)) / cell_m)
+    return row, col
+
+
+def cell_center(key: Tuple[int, int], cell_m: float) -> Tuple[float, float]:
+    row, col = key
+    lat = (row + 0.5) * cell_m / METERS_PER_DEG_LAT
+    lon = (col + 0.5) * cell_m / (METERS_PER_DEG_LAT * math.cos(math.radians(lat)))
+    return lat, lon
+
+
+def cell_bounds(key: Tuple[int, int], cell_m: float) -> Tuple[float, float, float, float]:
+    """(lat_min, lon_min, lat_max, lon_max) ячейки сетки cell_key."""
+    row, col = key
+    lon_step = cell_m / (METERS_PER_DEG_LAT * math.cos(math.radians((row + 0.5) * cell_m / METERS_PER_DEG_LAT)))
+    return row * cell_m / METERS_PER_DEG_LAT, col * lon_step, (row + 1) * cell_m / METERS_PER_DEG_LAT, (col + 1) * lon_step
+
+
+def simplify_path(coords: np.ndarray, tolerance_m: float) -> np.ndarray:
+    """
+    Упрощение полилинии (lat, lon) алгоритмом Дугласа-Пекера: выкидывает вершины, которые
+    отстоят от упрощенной линии не больше чем на tolerance_m. Крайние вершины сохраняются.
+    """
+    if tolerance_m <= 0 or len(coords) < 3: return coords
+    # Локальная равнопромежуточная проекция в метры: на длине одного сегмента дороги ее точности хватает
+    xy = np.column_stack([coords[:, 1] * METERS_PER_DEG_LAT * math.cos(math.radians(float(coords[0, 0]))),
+                          coords[:, 0] * METERS_PER_DEG_LAT])
+    keep = np.zeros(len(coords), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(coords) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2: continue
+        start, chord = xy[first], xy[last] - xy[first]
+        rel = xy[first + 1:last] - start
+        chord_len = math.hypot(*chord)
+        if chord_len == 0: distances = np.hypot(rel[:, 0], rel[:, 1])
+        else: distances = np.abs(chord[0] * rel[:, 1] - chord[1] * rel[:, 0]) / chord_len
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance_m:
+            split = first + 1 + farthest
+            keep[split] = True
+            stack.extend(((first, split), (split, last)))
+    return coords[keep]
+
+
+def default_cache_dir(csv_path: str) -> str:
+    return os.path.splitext(csv_path)[0] + ".roadcache"
+
+
+def _file_sha1(path: str) -> str:
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""): digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _source_signature(csv_path: str) -> dict:
+    st = os.stat(csv_path)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+def _pack_strings(strings: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """Строки одним буфером UTF-8 и смещениями: без выравнивания по самой длинной строке."""
+    encoded = [s.encode("utf-8") for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+
+def _unpack_strings(blob: np.ndarray, offsets: np.ndarray, start: int, stop: int) -> List[str]:
+    bounds = offsets[start:stop + 1].tolist()
+    data = blob[bounds[0]:bounds[-1]].tobytes()
+    base = bounds[0]
+    return [data[lo - base:hi - base].decode("utf-8") for lo, hi in zip(bounds, bounds[1:])]
+
+
+class RoadTable:
+    """
+    Сегменты дорог в колоночном виде: coords (N, 2) float64, offsets (M + 1,) int64,
+    имена и ObjectID - буферы UTF-8 со своими смещениями. Сегмент i - это coords[offsets[i]:offsets[i + 1]].
+    """
+    def __init__(self, coords: np.ndarray, offsets: np.ndarray, names_utf8: np.ndarray, name_offsets: np.ndarray,
+                 ids_utf8: np.ndarray, id_offsets: np.ndarray):
+        self.coords, self.offsets = coords, offsets
+        self.names_utf8, self.name_offsets = names_utf8, name_offsets
+        self.ids_utf8, self.id_offsets = ids_utf8, id_offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    @property
+    def vertex_count(self) -> int:
+        return int(self.offsets[-1])
+
+    def segment_coords(self, i: int) -> np.ndarray:
+        return self.coords[self.offsets[i]:self.offsets[i + 1]]
+
+    def iter_segments(self) -> Iterator[dict]:
+        """Лениво выдает сегменты как {'name', 'object_id', 'path'}, path - список (lat, lon)."""
+        # Преобразование в Python-объекты идет блоками: в памяти одновременно не больше ITER_BLOCK сегментов
+        for start in range(0, len(self), ITER_BLOCK):
+            stop = min(start + ITER_BLOCK, len(self))
+            bounds = self.offsets[start:stop + 1].tolist()
+            points = list(map(tuple, self.coords[bounds[0]:bounds[-1]].tolist()))
+            names = _unpack_strings(self.names_utf8, self.name_offsets, start, stop)
+            object_ids = _unpack_strings(self.ids_utf8, self.id_offsets, start, stop)
+            for i, (lo, hi) in enumerate(zip(bounds, bounds[1:])):
+                yield {"name": names[i], "object_id": object_ids[i], "path": points[lo - bounds[0]:hi - bounds[0]]}
+
+    @classmethod
+    def from_csv(cls, csv_path: str) -> "RoadTable":
+        """Потоковый разбор CSV: координаты копятся в компактных array('d'), а не в списках кортежей."""
+        coords, offsets, names, object_ids = array("d"), array("q", [0]), [], []
+        with open(csv_path, mode="r", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                pairs = WKT_PAIR_RE.findall((row.get("geometry_wkt") or "").strip())
+                if not pairs: continue
+                for lon, lat in pairs: coords.extend((float(lat), float(lon)))
+                offsets.append(len(coords) // 2)
+                names.append(fix_encoding((row.get("name") or row.get("name_ru") or "").strip()))
+                object_ids.append((row.get("objectid") or "").strip())
+        return cls(np.frombuffer(coords, dtype=np.float64).reshape(-1, 2), np.frombuffer(offsets, dtype=np.int64),
+                   *_pack_strings(names), *_pack_strings(object_ids))
+
+    def save(self, cache_dir: str, meta: dict) -> None:
+        tmp_dir = f"{cache_dir}.tmp-{os.getpid()}"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        for name in ARRAYS:
+            np.save(os.path.join(tmp_dir, f"{name}.npy"), getattr(self, name))
+        # meta.json пишется последним: кэш без него считается недостроенным
+        with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        os.replace(tmp_dir, cache_dir)
+
+    @classmethod
+    def open_cache(cls, cache_dir: str) -> "RoadTable":
+        arrays = {name: np.load(os.path.join(cache_dir, f"{name}.npy"), mmap_mode="r") for name in ARRAYS}
+        return cls(**arrays)
+
+
+def _read_cache_meta(cache_dir: str) -> Optional[dict]:
+    try:
+        with open(os.path.join(cache_dir, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return meta if meta.get("version") == CACHE_VERSION else None
+
+
+def load_roads(csv_path: str, cache_dir: Optional[str] = None, use_cache: bool = True) -> RoadTable:
+    """
+    RoadTable для CSV: из бинарного кэша, если он актуален, иначе разбором CSV с пересборкой кэша.
+    FileNotFoundError, если CSV нет (даже при наличии кэша).
+    """
+    signature = _source_signature(csv_path)
+    if not use_cache: return RoadTable.from_csv(csv_path)
+    cache_dir = cache_dir or default_cache_dir(csv_path)
+    meta = _read_cache_meta(cache_dir)
+    if meta is not None:
+        if meta["source"] == signature:
+            return RoadTable.open_cache(cache_dir)
+        # Файл трогали (скопировали, touch), но содержимое то же: кэш годен, обновляется только подпись
+        if meta["source"]["size"] == signature["size"] and meta["sha1"] == _file_sha1(csv_path):
+            meta["source"] = signature
+            with open(os.path.join(cache_dir, "meta.json"), "w", encoding="utf-8") as f:
+                json.dump(meta, f)
+            return RoadTable.open_cache(cache_dir)
+
+    sha1 = _file_sha1(csv_path)
+    table = RoadTable.from_csv(csv_path)
+    try:
+        table.save(cache_dir, {"version": CACHE_VERSION, "source": signature, "sha1": sha1,
+                               "segments": len(table), "vertices": table.vertex_count})
+        print(f"💾 Кэш геометрии дорог собран: {cache_dir} ({len(table)} сегментов, {table.vertex_count} вершин).")
+    except OSError as e:
+        print(f"⚠️ Не удалось сохранить кэш геометрии дорог {cache_dir}: {e}")
+    return table
+
+
+def iter_segments(csv_path: str, cache_dir: Optional[str] = None, use_cache: bool = True) -> Iterator[dict]:
+    """Генератор сегментов {'name', 'object_id', 'path'} из CSV с дорогами."""
+    yield from load_roads(csv_path, cache_dir, use_cache).iter_segments()
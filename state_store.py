@@ -0,0 +1,107 @@
+import os
+import json
+import sqlite3
+from typing import Iterable, List, Optional, Set, Tuple
+
+
+MASK_64 = (1 << 64) - 1
+
+
+def to_signed(value: int) -> int:
+    """uint64 -> int64: SQLite хранит только знаковые 64-битные целые."""
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+class YearStateStore:
+    """
+    Журнал состояния одного года (SQLite в режиме WAL) вместо state.pkl.
+
+    Каждая обработанная точка и каждый сохраненный вид записываются сразу отдельной короткой
+    транзакцией, поэтому аварийное завершение (OOM, SIGKILL) теряет не больше одной точки
+    "в полете". Возобновление не зависит от размера состояния: журнал не перечитывается
+    и не переписывается целиком, а номер последнего ID берется из индекса.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.is_new = not os.path.exists(path)
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS points (row INTEGER, col INTEGER, PRIMARY KEY (row, col)) WITHOUT ROWID")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS views (id INTEGER PRIMARY KEY, pano_id TEXT, view TEXT, log_row TEXT)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS views_pano_id ON views (pano_id)")
+            # pHash хранится как 64-битное целое (в SQLite - со знаком), view_id пуст у хэшей из state.pkl
+            self._conn.execute("CREATE TABLE IF NOT EXISTS phashes (hash INTEGER PRIMARY KEY, view_id INTEGER) WITHOUT ROWID")
+            # Строки no_panorama-лога, еще не сброшенные на диск с fsync (см. add_point)
+            self._conn.execute("CREATE TABLE IF NOT EXISTS no_panorama (seq INTEGER PRIMARY KEY, log_row TEXT)")
+
+    def get_meta(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key: str, value) -> None:
+        with self._conn: self._conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, str(value)))
+
+    def processed_cells(self) -> Set[Tuple[int, int]]:
+        return set(self._conn.execute("SELECT row, col FROM points"))
+
+    def replace_processed_cells(self, cells: Iterable[Tuple[int, int]]) -> None:
+        """Полностью переписывает список обработанных ячеек (импорт и смена размера ячейки)."""
+        with self._conn:
+            self._conn.execute("DELETE FROM points")
+            self._conn.executemany("INSERT OR IGNORE INTO points VALUES (?, ?)", cells)
+
+    def add_point(self, cell: Tuple[int, int], no_panorama_row: Optional[list] = None) -> None:
+        """
+        Ячейка и строка no_panorama-лога (если панорамы нет) пишутся одной транзакцией:
+        строка хранится в журнале, пока лог не сброшен с fsync (clear_no_panorama_rows).
+        """
+        with self._conn:
+            self._conn.execute("INSERT OR IGNORE INTO points VALUES (?, ?)", cell)
+            if no_panorama_row:
+                self._conn.execute("INSERT INTO no_panorama (log_row) VALUES (?)", (json.dumps(no_panorama_row, ensure_ascii=False),))
+
+    def pending_no_panorama_rows(self) -> List[list]:
+        return [json.loads(row[0]) for row in self._conn.execute("SELECT log_row FROM no_panorama ORDER BY seq")]
+
+    def clear_no_panorama_rows(self) -> None:
+        with self._conn: self._conn.execute("DELETE FROM no_panorama")
+
+    def add_view(self, view_id: int, pano_id: str, view: str, image_hash: int, log_row: Optional[list] = None) -> None:
+        """
+        Вид и его хэш пишутся одной транзакцией. log_row - строка metadata-лога: CSV пишется
+        с буфером, и по журналу потерянные при сбое строки дописываются при следующем запуске.
+        """
+        with self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO views VALUES (?, ?, ?, ?)",
+                               (view_id, pano_id, view, json.dumps(log_row, ensure_ascii=False) if log_row else None))
+            self._conn.execute("INSERT OR IGNORE INTO phashes VALUES (?, ?)", (to_signed(image_hash), view_id))
+
+    def import_legacy(self, cells: Iterable[Tuple[int, int]], views: Iterable[Tuple[int, str, str]], hashes: Iterable[int]) -> None:
+        """Одноразовый перенос state.pkl и metadata_{YEAR}.csv в журнал."""
+        with self._conn:
+            self._conn.executemany("INSERT OR IGNORE INTO points VALUES (?, ?)", cells)
+            self._conn.executemany("INSERT OR REPLACE INTO views VALUES (?, ?, ?, NULL)", views)
+            self._conn.executemany("INSERT OR IGNORE INTO phashes VALUES (?, NULL)", ((to_signed(h),) for h in hashes))
+
+    def logged_pano_ids(self) -> Set[str]:
+        return {row[0] for row in self._conn.execute("SELECT DISTINCT pano_id FROM views")}
+
+    def image_hashes(self) -> Tuple[List[int], List[int]]:
+        """(хэши как беззнаковые 64-битные целые, ID видов; -1 у хэшей без вида)."""
+        rows = self._conn.execute("SELECT hash, COALESCE(view_id, -1) FROM phashes").fetchall()
+        return [row[0] & MASK_64 for row in rows], [row[1] for row in rows]
+
+    def log_rows_after(self, view_id: int) -> List[list]:
+        return [json.loads(row[0]) for row in
+                self._conn.execute("SELECT log_row FROM views WHERE id > ? AND log_row IS NOT NULL ORDER BY id", (view_id,))]
+
+    def last_view_id(self) -> int:
+        return self._conn.execute("SELECT COALESCE(MAX(id), 0) FROM views").fetchone()[0]
+
+    def close(self) -> None:
+        # Сливаем WAL в основной файл, чтобы журнал не рос между запусками
+        self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self._conn.close()
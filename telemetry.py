@@ -0,0 +1,209 @@
+"""
+Телеметрия сборщика: таймеры стадий, счетчики и периодические отчеты о скорости.
+
+Латентности хранятся в логарифмических гистограммах (шаг 5%), поэтому память не растет
+с длиной прогона, а p50/p95/p99 считаются с точностью до ширины корзины. Метрики можно
+выгружать в файл для сбора во время долгих прогонов:
+  *.prom  - Prometheus textfile (перезаписывается атомарно, для node_exporter textfile collector);
+  иначе   - JSON lines, по одному снимку на строку.
+"""
+import os
+import json
+import math
+import time
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+QUANTILES = (0.5, 0.95, 0.99)
+BUCKET_GROWTH = 1.05
+MIN_SECONDS = 1e-6
+
+
+class LatencyHistogram:
+    """Логарифмическая гистограмма длительностей в секундах."""
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._buckets: Dict[int, int] = {}
+
+    def observe(self, seconds: float) -> None:
+        seconds = max(seconds, 0.0)
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        index = 0 if seconds <= MIN_SECONDS else int(math.log(seconds / MIN_SECONDS, BUCKET_GROWTH)) + 1
+        self._buckets[index] = self._buckets.get(index, 0) + 1
+
+    def quantile(self, q: float) -> float:
+        if not self.count: return 0.0
+        rank = q * self.count
+        seen = 0
+        for index in sorted(self._buckets):
+            seen += self._buckets[index]
+            if seen >= rank:
+                # Верхняя граница корзины, но не больше реального максимума
+                return min(self.max, MIN_SECONDS * BUCKET_GROWTH ** index)
+        return self.max
+
+
+class Telemetry:
+    """
+    Потокобезопасный сборщик метрик на весь прогон. Стадии измеряются через timer()/observe(),
+    события - через count() с необязательными метками (например, year или type), текущие
+    значения (например, действующий лимит запросов) - через gauge(). Отчеты печатает фоновый
+    поток (start_reporting), поэтому они идут и тогда, когда основной цикл стоит: размыкатель
+    разомкнут или точки ждут повтора.
+    """
+    def __init__(self, metrics_path: Optional[str] = None, report_seconds: float = 60.0):
+        self.metrics_path = metrics_path
+        self.report_seconds = report_seconds
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+        self._stages: Dict[str, LatencyHistogram] = {}
+        self._counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+        self._gauges: Dict[str, float] = {}
+        self._last_report = self.started
+        self._last_report_points = 0
+        self._progress = (0, 0)
+        self._report_lock = threading.Lock()
+        self._stop_reporting = threading.Event()
+        self._reporter: Optional[threading.Thread] = None
+
+    def observe(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self._stages.setdefault(stage, LatencyHistogram()).observe(seconds)
+
+    @contextmanager
+    def timer(self, stage: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def count(self, name: str, value: float = 1, **labels: str) -> None:
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def gauge(self, name: str, value: float) -> None:
+        with self._lock: self._gauges[name] = value
+
+    def counter(self, name: str, **labels: str) -> float:
+        """Значение счетчика; без меток - сумма по всем меткам."""
+        with self._lock:
+            if labels:
+                return self._counters.get((name, tuple(sorted((k, str(v)) for k, v in labels.items()))), 0)
+            return sum(value for (counter_name, _), value in self._counters.items() if counter_name == name)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            stages = {name: {"count": h.count, "sum_seconds": round(h.total, 6), "max_seconds": round(h.max, 6),
+                             **{f"p{int(q * 100)}_seconds": round(h.quantile(q), 6) for q in QUANTILES}}
+                      for name, h in self._stages.items()}
+            counters = [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in sorted(self._counters.items())]
+            gauges = dict(sorted(self._gauges.items()))
+        return {"timestamp": time.time(), "uptime_seconds": round(time.monotonic() - self.started, 3),
+                "stages": stages, "counters": counters, "gauges": gauges}
+
+    def set_progress(self, points_done: int, points_total: int) -> None:
+        """Прогресс для отчетов: points_done - точки, обработанные в этой сессии, из points_total."""
+        with self._lock: self._progress = (points_done, points_total)
+
+    def maybe_report(self, force: bool = False) -> None:
+        """
+        Раз в report_seconds печатает скорость (точек в минуту за последний интервал и за сессию)
+        и ETA до конца файла по последнему set_progress, а также выгружает метрики.
+        """
+        with self._report_lock:
+            now = time.monotonic()
+            if not force and now - self._last_report < self.report_seconds: return
+            with self._lock:
+                points_done, points_total = self._progress
+                gauges = "".join(f", {name}={value:g}" for name, value in sorted(self._gauges.items()))
+            interval = max(now - self._last_report, 1e-9)
+            recent_rate = (points_done - self._last_report_points) * 60.0 / interval
+            session_rate = points_done * 60.0 / max(now - self.started, 1e-9)
+            remaining = max(points_total - points_done, 0)
+            eta = format_eta(remaining / session_rate * 60.0) if session_rate > 0 else "--:--:--"
+            print(f"📈 Скорость: {recent_rate:.1f} точек/мин (в среднем {session_rate:.1f}), "
+                  f"обработано {points_done}, осталось {remaining}, ETA {eta}{gauges}")
+            self._last_report, self._last_report_points = now, points_done
+            self.write_metrics()
+
+    def start_reporting(self) -> None:
+        self._stop_reporting.clear()
+        self._reporter = threading.Thread(target=self._report_loop, name="telemetry-report", daemon=True)
+        self._reporter.start()
+
+    def stop_reporting(self) -> None:
+        self._stop_reporting.set()
+        if self._reporter is not None: self._reporter.join()
+        self._reporter = None
+
+    def _report_loop(self) -> None:
+        while not self._stop_reporting.wait(max(self._last_report + self.report_seconds - time.monotonic(), 0.05)):
+            self.maybe_report()
+
+    def write_metrics(self) -> None:
+        if not self.metrics_path: return
+        snapshot = self.snapshot()
+        try:
+            if self.metrics_path.endswith(".prom"):
+                tmp_path = f"{self.metrics_path}.tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f: f.write(to_prometheus(snapshot))
+                os.replace(tmp_path, self.metrics_path)
+            else:
+                with open(self.metrics_path, "a", encoding="utf-8") as f: f.write(json.dumps(snapshot, ensure_ascii=False) + "\n")
+        except OSError as e:
+            print(f"⚠️ Не удалось записать метрики в {self.metrics_path}: {e}")
+
+    def summary_lines(self) -> List[str]:
+        """Таблица стадий для итоговой статистики, по убыванию суммарного времени."""
+        snapshot = self.snapshot()
+        lines = [f"{'Стадия':<22}{'вызовов':>9}{'всего, с':>11}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}"]
+        for name, stage in sorted(snapshot["stages"].items(), key=lambda item: -item[1]["sum_seconds"]):
+            lines.append(f"{name:<22}{stage['count']:>9}{stage['sum_seconds']:>11.1f}{stage['p50_seconds'] * 1000:>10.1f}"
+                         f"{stage['p95_seconds'] * 1000:>10.1f}{stage['p99_seconds'] * 1000:>10.1f}")
+        for counter in snapshot["counters"]:
+            labels = ", ".join(f"{k}={v}" for k, v in counter["labels"].items())
+            value = counter["value"]
+            lines.append(f"{counter['name']}{'{' + labels + '}' if labels else ''}: {int(value) if float(value).is_integer() else value}")
+        for name, value in snapshot["gauges"].items(): lines.append(f"{name}: {value:g}")
+        return lines
+
+
+def format_eta(seconds: float) -> str:
+    m, s = divmod(int(seconds), 60)
+    h, m = divmod(m, 60)
+    return f"{h:02d}:{m:02d}:{s:02d}"
+
+
+def _prom_labels(labels: dict) -> str:
+    if not labels: return ""
+    escaped = (f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for k, v in labels.items())
+    return "{" + ",".join(escaped) + "}"
+
+
+def to_prometheus(snapshot: dict, prefix: str = "panorama_collector") -> str:
+    lines = [f"# TYPE {prefix}_stage_seconds summary"]
+    for name, stage in sorted(snapshot["stages"].items()):
+        for q in QUANTILES:
+            lines.append(f'{prefix}_stage_seconds{{stage="{name}",quantile="{q}"}} {stage[f"p{int(q * 100)}_seconds"]}')
+        lines.append(f'{prefix}_stage_seconds_sum{{stage="{name}"}} {stage["sum_seconds"]}')
+        lines.append(f'{prefix}_stage_seconds_count{{stage="{name}"}} {stage["count"]}')
+    seen_types = set()
+    for counter in snapshot["counters"]:
+        metric = f"{prefix}_{counter['name']}_total"
+        if metric not in seen_types:
+            lines.append(f"# TYPE {metric} counter")
+            seen_types.add(metric)
+        lines.append(f"{metric}{_prom_labels(counter['labels'])} {counter['value']}")
+    for name, value in snapshot["gauges"].items():
+        lines.append(f"# TYPE {prefix}_{name} gauge")
+        lines.append(f"{prefix}_{name} {value}")
+    lines.append(f"# TYPE {prefix}_uptime_seconds gauge")
+    lines.append(f"{prefix}_uptime_seconds {snapshot['uptime_seconds']}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,47 @@
+import random
+
+import pytest
+
+from dedup_index import HashIndex
+
+
+def flip_bits(value: int, bits: int, rng: random.Random) -> int:
+    for bit in rng.sample(range(64), bits): value ^= 1 << bit
+    return value
+
+
+def brute_force(hashes, query: int, threshold: int):
+    return sorted((label, bin(h ^ query).count("1")) for label, h in enumerate(hashes) if bin(h ^ query).count("1") <= threshold)
+
+
+@pytest.mark.parametrize("threshold", [0, 1, 4, 6, 12])
+def test_find_matches_brute_force(threshold):
+    rng = random.Random(threshold)
+    base = [rng.getrandbits(64) for _ in range(300)]
+    # Почти-дубликаты на разных расстояниях, чтобы были совпадения у самой границы порога
+    hashes = base + [flip_bits(rng.choice(base), rng.randint(0, threshold + 2), rng) for _ in range(300)]
+    index = HashIndex(threshold)
+    index.add_many(hashes[:400], range(400))
+    for label in range(400, len(hashes)): index.add(hashes[label], label)  # часть хэшей остается в буфере
+    queries = [flip_bits(rng.choice(hashes), rng.randint(0, threshold + 2), rng) for _ in range(200)] + [rng.getrandbits(64) for _ in range(50)]
+    for query in queries:
+        assert sorted(index.find(query)) == brute_force(hashes, query, threshold)
+
+
+def test_find_after_rebuild_and_lower_threshold():
+    rng = random.Random(7)
+    hashes = [rng.getrandbits(64) for _ in range(3000)]
+    index = HashIndex(4)
+    for label, value in enumerate(hashes): index.add(value, label)
+    assert len(index) == len(hashes)
+    for query in (flip_bits(value, 3, rng) for value in hashes[::97]):
+        assert sorted(index.find(query)) == brute_force(hashes, query, 4)
+        assert sorted(index.find(query, threshold=2)) == brute_force(hashes, query, 2)
+
+
+def test_nearest_distance():
+    index = HashIndex(4)
+    index.add_many([0b1111, 0xFFFF_0000_0000_0000], [1, 2])
+    assert index.nearest_distance(0b0111) == 1
+    assert index.nearest_distance(0x00FF_0000_0000_0000) is None
+    with pytest.raises(ValueError): HashIndex(64)
@@ -0,0 +1,33 @@
+import pytest
+
+from mainn import densify_path, haversine_m
+
+# Прямая вдоль меридиана с промежуточными вершинами через неравные промежутки и повтором вершины
+LINE = [(43.2000, 76.9), (43.2004, 76.9), (43.2004, 76.9), (43.2013, 76.9), (43.2030, 76.9)]
+
+
+def path_length(path):
+    return sum(haversine_m(*a, *b) for a, b in zip(path, path[1:]))
+
+
+def test_step_is_kept_across_vertices():
+    points = densify_path(LINE, 50.0)
+    assert points[0] == LINE[0] and points[-1] == LINE[-1]
+    gaps = [haversine_m(*a, *b) for a, b in zip(points, points[1:])]
+    # Шаг считается вдоль всей линии, а не заново от каждой вершины WKT; хвост короче шага
+    assert all(gap == pytest.approx(50.0, abs=1e-6) for gap in gaps[:-1])
+    assert 0 < gaps[-1] <= 50.0 + 1e-6
+    assert len(points) == int(path_length(LINE) // 50.0) + 2
+
+
+def test_short_path_and_disabled_step():
+    short = [(43.2, 76.9), (43.2001, 76.9)]
+    assert densify_path(short, 50.0) == short
+    assert densify_path(LINE, 0) == LINE
+    assert densify_path(LINE[:1], 50.0) == LINE[:1]
+
+
+def test_vertex_on_step_boundary_is_not_duplicated():
+    end = (43.2 + 100.0 / 111194.93, 76.9)  # ровно 100 м по дуге
+    points = densify_path([(43.2, 76.9), end], 50.0)
+    assert len(points) == 3 and points[-1] == end
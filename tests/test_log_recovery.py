@@ -0,0 +1,91 @@
+import csv
+import os
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+
+import mainn
+from dedup_index import HashIndex
+from log_writers import BufferedCsvWriter, last_csv_row, tail_csv_rows
+from telemetry import Telemetry
+
+
+def read_rows(path):
+    with open(path, newline="", encoding="utf-8") as f: return list(csv.reader(f))
+
+
+def test_writer_buffers_until_flush_rows_and_writes_header_once(tmp_path):
+    path = str(tmp_path / "log.csv")
+    writer = BufferedCsvWriter(path, header=["a", "b"], flush_rows=3, flush_seconds=3600)
+    writer.write_row([1, "x"])
+    writer.write_row([2, "y"])
+    assert read_rows(path) == [["a", "b"]]
+    writer.write_row([3, "z"])
+    assert read_rows(path) == [["a", "b"], ["1", "x"], ["2", "y"], ["3", "z"]]
+    writer.write_row([4, "w"])
+    writer.close()
+    reopened = BufferedCsvWriter(path, header=["a", "b"])
+    reopened.write_row([5, "v"])
+    reopened.close()
+    assert read_rows(path)[0] == ["a", "b"] and read_rows(path).count(["a", "b"]) == 1
+    assert last_csv_row(path) == ["5", "v"]
+    assert tail_csv_rows(path, 2) == [["4", "w"], ["5", "v"]]
+
+
+def test_tail_csv_rows_skips_cut_first_line(tmp_path):
+    path = str(tmp_path / "log.csv")
+    with open(path, "w", newline="", encoding="utf-8") as f: csv.writer(f).writerows([[i, "x" * 20] for i in range(100)])
+    rows = tail_csv_rows(path, 1000, tail_bytes=200)
+    assert rows and rows[-1] == ["99", "x" * 20]
+    assert all(len(row) == 2 and row[1] == "x" * 20 for row in rows)
+    assert tail_csv_rows(str(tmp_path / "missing.csv"), 5) == []
+
+
+@pytest.fixture
+def output_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(mainn, "OUTPUT_DIR_BASE", str(tmp_path))
+    return tmp_path
+
+
+def new_context():
+    return mainn.YearContext("2023", 25.0, HashIndex(4), Telemetry())
+
+
+def save_view(ctx, pano_id, image_hash):
+    pano = SimpleNamespace(id=pano_id, lat=43.2, lon=76.9, date=datetime(2023, 6, 1))
+    ctx.save_panorama_views(pano, [{"label": "front", "hash": f"{image_hash:016x}", "jpeg": b"jpeg"}], "17", "ул. Абая", "ul._Abaya")
+
+
+def test_rows_lost_in_crash_are_recovered(output_dir):
+    ctx = new_context()
+    save_view(ctx, "p1", 0x0F0F_0F0F_0F0F_0F0F)
+    ctx.mark_processed((1, 1))
+    ctx.log_no_panorama((1, 2), "ул. Абая", 43.21, 76.91, "17")
+    ctx.checkpoint()
+    save_view(ctx, "p2", 0xF0F0_F0F0_F0F0_F0F0)
+    ctx.mark_processed((1, 3))
+    ctx.log_no_panorama((1, 4), "ул. Абая", 43.22, 76.92, "18")
+    # Сбой: буферы логов не сброшены, журнал уже записан
+    metadata = read_rows(os.path.join(ctx.output_dir, "metadata_2023.csv"))
+    no_panorama = read_rows(os.path.join(ctx.output_dir, "no_panorama_addresses_2023.csv"))
+    assert [row[2] for row in metadata[1:]] == ["p1"] and len(no_panorama) == 1
+
+    recovered = new_context()
+    assert [row[2] for row in read_rows(recovered.log_file)[1:]] == ["p1", "p2"]
+    assert read_rows(recovered.bad_addresses_file) == [["ул. Абая", "43.21", "76.91", "17"], ["ул. Абая", "43.22", "76.92", "18"]]
+    assert recovered.global_id == 2 and {(1, 3), (1, 4)} <= recovered.processed_coords
+    recovered.save_state(0.0)
+
+
+def test_already_flushed_no_panorama_rows_are_not_duplicated(output_dir):
+    ctx = new_context()
+    ctx.log_no_panorama((2, 1), "пр. Райымбека", 43.1, 76.8, "5")
+    ctx.bad_addresses_writer.flush()  # сброшено без fsync и до очистки журнала
+    ctx.log_no_panorama((2, 2), "пр. Райымбека", 43.2, 76.8, "6")
+
+    recovered = new_context()
+    assert [row[3] for row in read_rows(recovered.bad_addresses_file)] == ["5", "6"]
+    assert recovered.store.pending_no_panorama_rows() == []
+    recovered.save_state(0.0)
+    assert [row[3] for row in read_rows(new_context().bad_addresses_file)] == ["5", "6"]
@@ -0,0 +1,63 @@
+import time
+
+import pytest
+
+from rate_limit import AdaptiveRateLimiter, CircuitBreaker
+
+
+def test_breaker_opens_after_threshold_and_closes_on_probe_success():
+    breaker = CircuitBreaker(failure_threshold=3, reset_seconds=0.05)
+    assert [breaker.record_failure() for _ in range(2)] == [False, False]
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.record_failure() is True
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.record_failure() is False  # уже разомкнута
+    waited = breaker.before_call()
+    assert waited > 0 and breaker.state == CircuitBreaker.HALF_OPEN
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.before_call() == 0.0
+
+
+def test_breaker_failed_probe_doubles_open_time_up_to_cap():
+    breaker = CircuitBreaker(failure_threshold=1, reset_seconds=0.02, max_reset_seconds=0.05)
+    breaker.record_failure()
+    opened = []
+    for _ in range(3):
+        breaker.before_call()
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        assert breaker.record_failure() is True
+        opened.append(breaker._open_seconds)
+    assert opened == [0.04, 0.05, 0.05]
+    breaker.record_success()
+    assert breaker._open_seconds == 0.02  # после успеха срок снова начальный
+
+
+def test_breaker_success_resets_failure_streak():
+    breaker = CircuitBreaker(failure_threshold=2, reset_seconds=1.0)
+    breaker.record_failure()
+    breaker.record_success()
+    assert breaker.record_failure() is False
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_limiter_additive_increase_capped_at_max_rate():
+    limiter = AdaptiveRateLimiter(rate=2.0, min_rate=1.0, max_rate=3.0, increase=1.0)
+    limiter.on_success()
+    assert limiter.rate == pytest.approx(2.5)  # +increase/rate на ответ
+    for _ in range(10): limiter.on_success()
+    assert limiter.rate == 3.0
+
+
+def test_limiter_multiplicative_decrease_with_cooldown_and_floor():
+    limiter = AdaptiveRateLimiter(rate=8.0, min_rate=1.5, max_rate=8.0, decrease=0.5, cooldown_seconds=0.05)
+    assert limiter.on_failure() is True and limiter.rate == 4.0
+    assert limiter.on_failure() is False and limiter.rate == 4.0  # серия ошибок в пределах cooldown
+    time.sleep(0.06)
+    assert limiter.on_failure() is True and limiter.rate == 2.0
+    time.sleep(0.06)
+    assert limiter.on_failure() is True and limiter.rate == 1.5
+
+
+def test_limiter_rejects_inconsistent_bounds():
+    with pytest.raises(ValueError): AdaptiveRateLimiter(rate=5.0, min_rate=1.0, max_rate=4.0)
@@ -0,0 +1,80 @@
+import os
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+import pytest
+
+from image_pipeline import render_views
+from raw_store import RawPanoramaStore, effective_zoom
+
+
+def put_file(store, pano_id, size=1000, **kwargs):
+    tmp_path = store.tmp_path(pano_id)
+    with open(tmp_path, "wb") as f: f.write(b"x" * size)
+    return store.put(pano_id, tmp_path, "2023", **kwargs)
+
+
+def test_coarser_source_is_not_reused_for_finer_zoom(tmp_path):
+    coarse = RawPanoramaStore(str(tmp_path), zoom=2)
+    put_file(coarse, "p1")
+    coarse.release("p1")
+    assert RawPanoramaStore(str(tmp_path), zoom=0).acquire("p1", "2023") is None
+    assert RawPanoramaStore(str(tmp_path), zoom=3).acquire("p1", "2023") is not None
+    # В индекс пишется реально скачанный уровень, а не запрошенный
+    fine = RawPanoramaStore(str(tmp_path), zoom=4)
+    put_file(fine, "p2", zoom=1)
+    fine.release("p2")
+    assert RawPanoramaStore(str(tmp_path), zoom=1).acquire("p2", "2023") is not None
+
+
+def test_effective_zoom_clamps_to_available_levels():
+    pano = SimpleNamespace(image_sizes=[object()] * 3)
+    assert [effective_zoom(pano, zoom) for zoom in range(5)] == [0, 1, 2, 2, 2]
+    with pytest.raises(ValueError): effective_zoom(SimpleNamespace(image_sizes=None), 0)
+
+
+def test_pins_of_another_store_instance_block_eviction(tmp_path):
+    holder = RawPanoramaStore(str(tmp_path))
+    evicting = RawPanoramaStore(str(tmp_path), max_bytes=2500)
+    put_file(holder, "held")
+    for pano_id in ("a", "b", "c"):
+        put_file(evicting, pano_id)
+        evicting.release(pano_id)
+    assert os.path.exists(os.path.join(str(tmp_path), "held.jpg"))
+    assert evicting.evicted_files == 2
+    holder.release("held")
+    put_file(evicting, "d")
+    evicting.release("d")
+    assert not os.path.exists(os.path.join(str(tmp_path), "held.jpg"))
+
+
+def test_band_replaces_full_file_after_last_release(tmp_path):
+    store = RawPanoramaStore(str(tmp_path), mode="band")
+    other = RawPanoramaStore(str(tmp_path), mode="band")
+    entry = put_file(store, "p1", size=5000)
+    assert entry.band_path == os.path.join(str(tmp_path), "p1.band.jpg")
+    with open(entry.band_path, "wb") as f: f.write(b"x" * 1000)
+    assert other.acquire("p1", "2023") == entry  # полосы еще нет в индексе
+    store.put_band("p1", "2023", (512, 2048))
+    assert store.total_bytes == 1000
+    assert other.acquire("p1", "2023") == (entry.band_path, 512, 2048, None)
+    store.release("p1")
+    assert os.path.exists(entry.path)  # другой экземпляр еще держит панораму
+    other.release("p1")
+    assert os.path.exists(entry.path)
+    other.release("p1")
+    assert not os.path.exists(entry.path)
+
+
+def test_render_views_writes_band_on_first_use(tmp_path):
+    img = np.random.default_rng(0).integers(0, 256, (1024, 2048, 3), dtype=np.uint8)
+    raw_path, band_path = str(tmp_path / "p1.jpg"), str(tmp_path / "p1.band.jpg")
+    cv2.imwrite(raw_path, img)
+    views, timings, band = render_views(raw_path, "2023", band_to=(band_path, 256, 256))
+    assert views and "crop_to_band" in timings
+    row_offset, full_height = band
+    assert full_height == 1024 and cv2.imread(band_path).shape[1] == 2048
+    band_views, _, _ = render_views(band_path, "2023", row_offset, full_height)
+    assert [v["label"] for v in band_views] == [v["label"] for v in views]
+    assert sorted(os.listdir(str(tmp_path))) == ["p1.band.jpg", "p1.jpg"]